@@ -0,0 +1 @@
+"""Importable pieces of the MTCT CT/MR head-and-neck segmentation pipeline."""
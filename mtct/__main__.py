@@ -0,0 +1,5 @@
+import sys
+
+from mtct.cli import main
+
+sys.exit(main())
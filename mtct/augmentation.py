@@ -0,0 +1,140 @@
+"""Batched 3D augmentation on the training device.
+
+BatchAugmentation runs on whole (B, 2, D, H, W) batches after they were copied to the device,
+so the DataLoader workers do no extra work. Per sample it draws random flips, a small affine
+transform (rotation, scaling, translation) and optionally a smooth elastic displacement, and
+combines them into one sampling grid. The images are resampled trilinearly, the labels with
+nearest-neighbour lookups of the same grid, so all label channels stay aligned with the images
+and binary. Labels may be dense (B, C, D, H, W) masks or (B, D, H, W) bitfields (mtct.bitfield),
+which are moved around as they are. CT and MR get their own intensity jitter afterwards.
+
+All random parameters come from one generator seeded with seed, so a run is reproducible:
+
+    augmentation = BatchAugmentation(seed=0)
+    train_model_with_early_stopping(model, train_loader, ..., augmentation=augmentation)
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+class BatchAugmentation:
+    def __init__(self, flip_prob=0.5, flip_axes=(0, 1, 2), affine_prob=0.5, rotation_degrees=10.0, scale_range=0.1,
+                 translation=0.05, elastic_prob=0.0, elastic_magnitude=0.02, elastic_grid=4,
+                 intensity_prob=0.5, ct_scale=0.05, ct_shift=0.05, mr_scale=0.15, mr_shift=0.1, noise_std=0.0,
+                 seed=None):
+        self.flip_prob = flip_prob
+        self.flip_axes = tuple(flip_axes)
+        self.affine_prob = affine_prob
+        self.rotation = math.radians(rotation_degrees)
+        self.scale_range = scale_range
+        self.translation = translation
+        self.elastic_prob = elastic_prob
+        self.elastic_magnitude = elastic_magnitude
+        self.elastic_grid = elastic_grid
+        self.intensity_prob = intensity_prob
+        # (scale, shift) ranges of the CT and MR channel
+        self.intensity_ranges = ((ct_scale, ct_shift), (mr_scale, mr_shift))
+        self.noise_std = noise_std
+        self.generator = torch.Generator()
+        self.generator.manual_seed(torch.initial_seed() if seed is None else seed)
+
+    # Uniform samples in [-bound, bound] from the CPU generator
+    def _uniform(self, shape, bound):
+        return (torch.rand(shape, generator=self.generator) * 2.0 - 1.0) * bound
+
+    def _chance(self, batch_size, prob):
+        return torch.rand(batch_size, generator=self.generator) < prob
+
+    # (B, 3, 4) affine matrices (in affine_grid's x, y, z = W, H, D order)
+    def _affine_matrices(self, batch_size):
+        theta = torch.eye(3).repeat(batch_size, 1, 1)
+
+        apply = self._chance(batch_size, self.affine_prob)
+        angles = self._uniform((batch_size, 3), self.rotation) * apply[:, None]
+        scales = 1.0 + self._uniform((batch_size, 3), self.scale_range) * apply[:, None]
+        shifts = self._uniform((batch_size, 3), self.translation) * apply[:, None]
+        cos, sin = torch.cos(angles), torch.sin(angles)
+        for axis, (i, j) in enumerate(((1, 2), (0, 2), (0, 1))):
+            rotation = torch.eye(3).repeat(batch_size, 1, 1)
+            rotation[:, i, i] = cos[:, axis]
+            rotation[:, j, j] = cos[:, axis]
+            rotation[:, i, j] = -sin[:, axis]
+            rotation[:, j, i] = sin[:, axis]
+            theta = rotation @ theta
+        theta = theta * scales[:, None, :]
+
+        # Flips of the volume axes D, H, W are sign flips of z, y, x
+        for axis in self.flip_axes:
+            flip = self._chance(batch_size, self.flip_prob)
+            theta[:, :, 2 - axis] *= torch.where(flip, -1.0, 1.0)[:, None]
+
+        return torch.cat([theta, shifts[:, :, None]], dim=2)
+
+    def _grid(self, batch_size, spatial_shape, device):
+        theta = self._affine_matrices(batch_size).to(device)
+        grid = F.affine_grid(theta, (batch_size, 1) + tuple(spatial_shape), align_corners=False)
+
+        apply = self._chance(batch_size, self.elastic_prob)
+        if apply.any():
+            coarse = self._uniform((batch_size, 3) + (self.elastic_grid,) * 3, self.elastic_magnitude)
+            coarse = (coarse * apply[:, None, None, None, None]).to(device)
+            displacement = F.interpolate(coarse, size=tuple(spatial_shape), mode='trilinear', align_corners=False)
+            grid = grid + displacement.permute(0, 2, 3, 4, 1)
+        return grid
+
+    # Nearest-neighbour lookup of volume (B, ..., D, H, W) at grid, for any dtype (e.g. bitfields).
+    # Voxels sampled from outside the volume are 0, like grid_sample's zero padding.
+    @staticmethod
+    def _sample_nearest(volume, grid):
+        spatial_shape = volume.shape[-3:]
+        indices = []
+        inside = torch.ones(grid.shape[:-1], dtype=torch.bool, device=grid.device)
+        for coordinate, size in zip((grid[..., 2], grid[..., 1], grid[..., 0]), spatial_shape):
+            index = torch.round(((coordinate + 1.0) * size - 1.0) / 2.0).long()
+            inside &= (index >= 0) & (index < size)
+            indices.append(index.clamp(0, size - 1))
+
+        batch_index = torch.arange(volume.shape[0], device=volume.device).view(-1, 1, 1, 1)
+        if volume.dim() == 4:
+            sampled = volume[batch_index, indices[0], indices[1], indices[2]]
+            return torch.where(inside, sampled, torch.zeros_like(sampled))
+        # (B, D, H, W, C) -> (B, C, D, H, W)
+        sampled = volume.movedim(1, -1)[batch_index, indices[0], indices[1], indices[2]]
+        sampled = torch.where(inside[..., None], sampled, torch.zeros_like(sampled))
+        return sampled.movedim(-1, 1)
+
+    def _jitter_intensities(self, images):
+        batch_size, num_channels = images.shape[:2]
+        apply = self._chance(batch_size, self.intensity_prob)
+        scale = torch.ones(batch_size, num_channels)
+        shift = torch.zeros(batch_size, num_channels)
+        for channel, (scale_range, shift_range) in enumerate(self.intensity_ranges[:num_channels]):
+            scale[:, channel] += self._uniform(batch_size, scale_range) * apply
+            shift[:, channel] += self._uniform(batch_size, shift_range) * apply
+        shape = (batch_size, num_channels, 1, 1, 1)
+        images = images * scale.to(images.device).view(shape) + shift.to(images.device).view(shape)
+
+        if self.noise_std > 0:
+            # Noise on the device, from a device generator seeded by the CPU generator
+            noise_generator = torch.Generator(device=images.device)
+            noise_generator.manual_seed(int(torch.randint(2**62, (1,), generator=self.generator)))
+            images = images + self.noise_std * torch.randn(images.shape, generator=noise_generator,
+                                                           device=images.device, dtype=images.dtype)
+        return images
+
+    # Augment a batch on its device, returns (images, labels) with the same shapes and dtypes
+    def __call__(self, images, labels):
+        grid = self._grid(images.shape[0], images.shape[-3:], images.device)
+        images = F.grid_sample(images, grid.to(images.dtype), mode='bilinear', padding_mode='zeros',
+                               align_corners=False)
+        labels = self._sample_nearest(labels, grid)
+        return self._jitter_intensities(images), labels
+
+    # Generator state, to resume an augmented run with the same random stream
+    def state_dict(self):
+        return {"generator": self.generator.get_state()}
+
+    def load_state_dict(self, state):
+        self.generator.set_state(state['generator'])
@@ -0,0 +1,190 @@
+"""Stage-by-stage CPU benchmark of the pipeline on synthetic NRRD cases.
+
+Writes synthetic CT/MR/30-label cases to a local folder, times every stage (load_data,
+resize_image, scale_data/normalize_data, collate, forward/backward of the three models and the
+test metrics) and emits the results as JSON, so runs can be compared between changes:
+
+    python -m mtct.benchmark --output bench.json --cases 2 --size 64
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+
+from mtct.data import load_data, resize_image
+from mtct.labels import label_order
+from mtct.evaluation import test_model
+from mtct.loader import CaseTensorDataset, cpu_collate, custom_collate
+from mtct.metrics import SegmentationMetrics
+from mtct.models import YourModel, load_model_last_layer, load_model_last_two_layers
+from mtct.normalization import normalize_data, scale_data
+
+# Write num_cases synthetic cases (IMG_CT, IMG_MR and one mask per label_order entry) to root.
+# The volumes have shape (D, H, W), anisotropic spacing and an ellipsoid blob per structure.
+def write_synthetic_cases(root, num_cases=2, shape=(96, 160, 160), spacing=(1.0, 1.0, 2.5), seed=0):
+    rng = np.random.default_rng(seed)
+    zz, yy, xx = np.meshgrid(*[np.linspace(-1, 1, n, dtype=np.float32) for n in shape], indexing='ij')
+    case_folders = []
+
+    for case in range(num_cases):
+        case_folder = os.path.join(root, f"case_{case:03d}")
+        os.makedirs(case_folder, exist_ok=True)
+
+        head = (zz ** 2 + yy ** 2 + xx ** 2 < 0.8).astype(np.float32)
+        ct = (head * 1000.0 - 1000.0 + rng.normal(0, 30, shape)).astype(np.int16)
+        mr = (head * 400.0 + rng.normal(0, 20, shape)).astype(np.float32)
+        for name, volume in (('IMG_CT', ct), ('IMG_MR', mr)):
+            image = sitk.GetImageFromArray(volume)
+            image.SetSpacing(spacing[::-1])
+            sitk.WriteImage(image, os.path.join(case_folder, f"{name}.nrrd"), useCompression=True)
+
+        for name in label_order:
+            centre = rng.uniform(-0.5, 0.5, 3)
+            radius = rng.uniform(0.05, 0.25)
+            mask = ((zz - centre[0]) ** 2 + (yy - centre[1]) ** 2 + (xx - centre[2]) ** 2 < radius ** 2)
+            image = sitk.GetImageFromArray(mask.astype(np.uint8))
+            image.SetSpacing(spacing[::-1])
+            sitk.WriteImage(image, os.path.join(case_folder, f"Mask_{name}.nrrd"), useCompression=True)
+
+        case_folders.append(case_folder)
+    return case_folders
+
+# Run fn repeat times (after warmup runs) and return its timing statistics in seconds
+def time_stage(fn, repeat=3, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"mean": float(np.mean(times)), "min": float(np.min(times)), "max": float(np.max(times)), "repeat": repeat}
+
+def _forward_backward(model, inputs, labels):
+    model.zero_grad(set_to_none=True)
+    loss = model.loss_function(model(inputs), labels)
+    loss.backward()
+
+def run_benchmark(work_dir=None, num_cases=2, case_shape=(96, 160, 160), reference_size=(128, 128, 128),
+                  batch_size=2, repeat=3, threads=None, seed=0):
+    if threads is not None:
+        torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    device = torch.device('cpu')
+    stages = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        case_root = work_dir or tmp_dir
+        case_folders = write_synthetic_cases(case_root, num_cases=num_cases, shape=case_shape, seed=seed)
+
+        stages['load_data'] = time_stage(
+            lambda: load_data(case_folders[0], reference_size=reference_size, label_order=label_order),
+            repeat=repeat)
+        ct_image = sitk.ReadImage(os.path.join(case_folders[0], 'IMG_CT.nrrd'))
+        stages['resize_image'] = time_stage(lambda: resize_image(ct_image, reference_size), repeat=repeat)
+
+        loaded_data = [load_data(folder, reference_size=reference_size, label_order=label_order)
+                       for folder in case_folders]
+        if tuple(reference_size) == (128, 128, 128):
+            stages['scale_data'] = time_stage(lambda: scale_data(loaded_data), repeat=repeat)
+        else:
+            stages['scale_data'] = {"skipped": "scale_data only supports 128^3 volumes"}
+        stages['normalize_data'] = time_stage(
+            lambda: normalize_data([dict(data, image=data['image'].copy()) for data in loaded_data],
+                                   reference_size=reference_size, verbose=False),
+            repeat=repeat)
+
+        scaled_data = normalize_data(loaded_data, reference_size=reference_size, verbose=False)
+        batch_cases = [scaled_data[i % len(scaled_data)] for i in range(batch_size)]
+        stages['custom_collate'] = time_stage(lambda: custom_collate(batch_cases, device=device), repeat=repeat)
+        tensor_dataset = CaseTensorDataset(batch_cases)
+        stages['cpu_collate'] = time_stage(
+            lambda: cpu_collate([tensor_dataset[i] for i in range(len(tensor_dataset))]), repeat=repeat)
+
+    batch = cpu_collate([tensor_dataset[i] for i in range(len(tensor_dataset))])
+    inputs, labels = batch['images'], batch['labels']
+    models = {
+        'YourModel': YourModel(num_classes=len(label_order)),
+        'UNetWithLastLayerFineTuning': load_model_last_layer(len(label_order), load_pretrained=False, device=device),
+        'UNetWithTwoChannels': load_model_last_two_layers(len(label_order), load_pretrained=False, device=device),
+    }
+
+    for name, model in models.items():
+        model.to(device).train()
+        stages[f'{name}.forward_backward'] = time_stage(lambda: _forward_backward(model, inputs, labels), repeat=repeat)
+        model.eval()
+        with torch.no_grad():
+            stages[f'{name}.forward'] = time_stage(lambda: model(inputs), repeat=repeat)
+
+    model = models['YourModel']
+    with torch.no_grad():
+        outputs = model(inputs)
+
+    def metrics_stage():
+        metrics = SegmentationMetrics(num_channels=len(label_order))
+        metrics.update(outputs, labels)
+        metrics.compute()
+
+    stages['metrics'] = time_stage(metrics_stage, repeat=repeat)
+    stages['test_model'] = time_stage(
+        lambda: test_model(model, [batch], model.loss_function, device, num_output_channels=len(label_order)),
+        repeat=repeat)
+
+    return {
+        "config": {
+            "num_cases": num_cases,
+            "case_shape": list(case_shape),
+            "reference_size": list(reference_size),
+            "batch_size": batch_size,
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "numpy": np.__version__,
+            "simpleitk": sitk.Version.VersionString(),
+            "torch_threads": torch.get_num_threads(),
+            "cpu_count": os.cpu_count(),
+            "platform": platform.platform(),
+        },
+        "stages": stages,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the MTCT pipeline stages on synthetic cases (CPU).")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--work-dir', help="keep the synthetic cases in this folder")
+    parser.add_argument('--cases', type=int, default=2)
+    parser.add_argument('--case-shape', type=int, nargs=3, default=(96, 160, 160), metavar=('D', 'H', 'W'))
+    parser.add_argument('--size', type=int, default=128, help="reference_size edge length")
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # The pipeline functions print progress, keep stdout for the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_benchmark(work_dir=args.work_dir, num_cases=args.cases, case_shape=tuple(args.case_shape),
+                                reference_size=(args.size,) * 3, batch_size=args.batch_size, repeat=args.repeat,
+                                threads=args.threads, seed=args.seed)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    return results
+
+if __name__ == '__main__':
+    main()
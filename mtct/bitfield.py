@@ -0,0 +1,47 @@
+"""Label masks packed into one int32 bitfield volume per case.
+
+Bit c of a voxel is set when the voxel belongs to label channel c, so the 30 binary channels of
+a case take 4 bytes per voxel instead of 120 as float32. Cases are kept and batched in this form
+(in RAM, through the DataLoader and across the host-to-device copy) and only expanded into the
+(B, C, D, H, W) float target on the device, right before the loss:
+
+    labels = dense_labels(batch['labels'].to(device), num_labels=30)
+"""
+
+import numpy as np
+import torch
+
+MAX_BITFIELD_LABELS = 32
+
+# (C, D, H, W) masks (anything > 0.5 counts as set) -> (D, H, W) int32 bitfield
+def pack_label_bits(labels):
+    labels = np.asarray(labels) > 0.5
+    if labels.shape[0] > MAX_BITFIELD_LABELS:
+        raise ValueError(f"At most {MAX_BITFIELD_LABELS} labels fit into an int32 bitfield, got {labels.shape[0]}")
+    packed = np.packbits(labels, axis=0, bitorder='little')
+    packed = np.concatenate([packed, np.zeros((4 - packed.shape[0],) + packed.shape[1:], dtype=np.uint8)])
+    return np.ascontiguousarray(np.moveaxis(packed, 0, -1)).view('<i4')[..., 0].astype(np.int32, copy=False)
+
+# Binary mask of one channel of a bitfield (numpy or torch)
+def label_channel_mask(bits, channel):
+    return (bits >> channel) & 1
+
+# Bitfield (..., D, H, W) -> (..., num_labels, D, H, W) masks of dtype, computed where bits lives
+def unpack_label_bits(bits, num_labels, dtype=torch.float32):
+    shifts = torch.arange(num_labels, device=bits.device, dtype=torch.int32).view(-1, 1, 1, 1)
+    return ((bits.unsqueeze(-4) >> shifts) & 1).to(dtype)
+
+# Batch labels as the dense float target: bitfield batches (B, D, H, W) are unpacked,
+# dense (B, C, D, H, W) batches are passed through
+def dense_labels(labels, num_labels, dtype=torch.float32):
+    if labels.dim() == 4 and not labels.is_floating_point():
+        return unpack_label_bits(labels, num_labels, dtype=dtype)
+    return labels.to(dtype)
+
+# Replace the labels of every case by their bitfield, in place (for a cohort held in memory).
+# Returns cases.
+def pack_cases(cases):
+    for data in cases:
+        if data is not None:
+            data['labels'] = pack_label_bits(data['labels'])
+    return cases
@@ -0,0 +1,191 @@
+"""Per-case preprocessing cache keyed by the case's NRRD files and the preprocessing parameters.
+
+The key of a case is a hash over its resolved folder path and the name, size and modification
+time of every NRRD file in it (or only the content hashes of the files), plus reference_size,
+label_order and CACHE_VERSION. A changed file or parameter gives a new key, so stale results
+are never returned; only new or changed cases are run through load_data again. Entries are
+evicted least-recently-used under a size budget.
+
+Layout of the cache directory:
+
+    index.json          case folder -> key of its current entry
+    <key>/image.npy     (2, D, H, W) resized CT + MR
+    <key>/labels.npy    (30, D, H, W) uint8 masks
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from mtct.labels import label_order as default_label_order
+from mtct.data import case_folder_of, load_data_parallel
+
+# Bump when load_data/resize_image change their output, to invalidate all cached cases
+# (2: labels mapped to their label_order channel exactly)
+CACHE_VERSION = 2
+INDEX_NAME = 'index.json'
+
+def _file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Cache key of a case folder (or case index entry). The files are always listed on disk, never
+# taken from the stats recorded in an index, so a file changed after the index was built gives
+# a new key. The stats alone don't tell two cases with the same file names, sizes and mtimes
+# apart, so the resolved case folder is part of the key too. With hash_contents=True the files
+# are hashed instead (slower, but robust to copies that reset mtimes) and the key doesn't depend
+# on where the case lives.
+def case_fingerprint(case_folder, reference_size=(128, 128, 128), label_order=default_label_order,
+                     hash_contents=False):
+    case_folder = case_folder_of(case_folder)
+    files = []
+    with os.scandir(case_folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.nrrd'):
+                continue
+            if hash_contents:
+                files.append((entry.name, _file_digest(entry.path)))
+            else:
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+
+    description = {
+        "version": CACHE_VERSION,
+        "reference_size": list(reference_size),
+        "label_order": list(label_order) if label_order else None,
+        "files": sorted(files),
+    }
+    if not hash_contents:
+        description["case_folder"] = os.path.realpath(case_folder)
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:32]
+
+class PreprocessingCache:
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    def _load_index(self):
+        index_path = os.path.join(self.cache_dir, INDEX_NAME)
+        if not os.path.exists(index_path):
+            return {}
+        with open(index_path) as file:
+            return json.load(file)
+
+    def _save_index(self):
+        index_tmp = os.path.join(self.cache_dir, INDEX_NAME + '.tmp')
+        with open(index_tmp, 'w') as file:
+            json.dump(self.index, file, indent=2)
+        os.replace(index_tmp, os.path.join(self.cache_dir, INDEX_NAME))
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self._entry_dir(key), 'labels.npy'))
+
+    # Cached case for key, or None. Hits are marked as recently used.
+    def get(self, key, mmap_mode=None):
+        if key not in self:
+            return None
+        entry_dir = self._entry_dir(key)
+        os.utime(entry_dir)
+        return {
+            "image": np.load(os.path.join(entry_dir, 'image.npy'), mmap_mode=mmap_mode),
+            "labels": np.load(os.path.join(entry_dir, 'labels.npy'), mmap_mode=mmap_mode),
+        }
+
+    # Store the preprocessed case of case_folder under key. The previous entry of the same folder
+    # (computed from older files or other parameters) is removed right away.
+    def put(self, key, data, case_folder=None):
+        entry_tmp = self._entry_dir(key) + '.tmp'
+        shutil.rmtree(entry_tmp, ignore_errors=True)
+        os.makedirs(entry_tmp)
+        np.save(os.path.join(entry_tmp, 'image.npy'), np.asarray(data['image']))
+        np.save(os.path.join(entry_tmp, 'labels.npy'), np.asarray(data['labels']))
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+        os.replace(entry_tmp, self._entry_dir(key))
+
+        if case_folder is not None:
+            old_key = self.index.get(case_folder)
+            self.index[case_folder] = key
+            if old_key is not None and old_key != key and old_key not in self.index.values():
+                shutil.rmtree(self._entry_dir(old_key), ignore_errors=True)
+            self._save_index()
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.cache_dir) as items:
+            for item in items:
+                if not item.is_dir() or item.name.endswith('.tmp'):
+                    continue
+                size = sum(f.stat().st_size for f in os.scandir(item.path) if f.is_file())
+                entries.append((item.stat().st_mtime, size, item.name))
+        return entries
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    # Remove least recently used entries until the cache fits into max_bytes.
+    # Returns the evicted keys.
+    def evict(self, max_bytes=None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return []
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, key in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= size
+            evicted.append(key)
+
+        if evicted:
+            self.index = {folder: key for folder, key in self.index.items() if key not in evicted}
+            self._save_index()
+        return evicted
+
+# load_data_parallel with the cache in front: cached cases are read back, only new or changed
+# case folders are decoded and resampled (in parallel). Every recomputed case is stored as soon
+# as it is done, so an interrupted run keeps the cases finished so far; with mmap_mode set it is
+# then read back memory-mapped, so the recomputed cases don't all stay in RAM either.
+# case_folders may be case index entries (mtct.index) as well.
+# Returns (loaded_data, stats) like load_data_parallel, with the hit/miss counts added.
+def load_cases_cached(case_folders, cache, reference_size=(128, 128, 128), label_order=default_label_order,
+                      num_workers=None, max_in_flight=None, hash_contents=False, mmap_mode=None):
+    start = time.perf_counter()
+    keys = [case_fingerprint(folder, reference_size, label_order, hash_contents=hash_contents) for folder in case_folders]
+    results = [cache.get(key, mmap_mode=mmap_mode) for key in keys]
+    missing = [i for i, data in enumerate(results) if data is None]
+
+    stats = {"num_workers": 0, "stage_times": {}}
+    if missing:
+        def store(position, data):
+            i = missing[position]
+            cache.put(keys[i], data, case_folder=case_folder_of(case_folders[i]))
+            return cache.get(keys[i], mmap_mode=mmap_mode) if mmap_mode else data
+
+        # keep_failed keeps the results aligned with the missing indices
+        loaded, stats = load_data_parallel([case_folders[i] for i in missing], num_workers=num_workers,
+                                           max_in_flight=max_in_flight, reference_size=reference_size,
+                                           label_order=label_order, keep_failed=True, on_result=store)
+        for i, data in zip(missing, loaded):
+            results[i] = data
+        cache.evict()
+
+    loaded_data = [data for data in results if data is not None]
+    stats = dict(stats, num_cases=len(loaded_data), cache_hits=len(case_folders) - len(missing),
+                 cache_misses=len(missing), wall_time=time.perf_counter() - start)
+    print(f"Loaded {stats['num_cases']} cases ({stats['cache_hits']} from cache, {stats['cache_misses']} recomputed) "
+          f"in {stats['wall_time']:.1f}s")
+    return loaded_data, stats
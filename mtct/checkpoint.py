@@ -0,0 +1,124 @@
+"""Background, resumable training checkpoints.
+
+CheckpointManager.save copies the training state to CPU memory and hands it to a writer thread,
+so the training loop only waits for the copy, not for torch.save to (network) storage. Files are
+written under a temporary name and renamed into place, so a preempted run never leaves a
+truncated checkpoint behind.
+
+Layout of a checkpoint directory:
+
+    checkpoints.json        epoch and metric of every kept checkpoint
+    epoch_0001.pth          model, optimizer, LR scheduler, GradScaler (and augmentation) state, epoch,
+    epoch_0002.pth          early-stopping counter, best loss and loss history
+    ...
+
+The last keep_last checkpoints and the keep_best ones with the lowest metric are kept. The
+files use the model_state_dict / optimizer_state_dict keys of save_load_model, so they can be
+loaded with it as well.
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+INDEX_NAME = 'checkpoints.json'
+
+# Copy of state with every tensor detached and copied to CPU, so training can go on while it is written
+def snapshot_to_cpu(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot_to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_to_cpu(value) for value in state)
+    return state
+
+class CheckpointManager:
+    def __init__(self, checkpoint_dir, keep_last=2, keep_best=1):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.entries = self._load_index()
+        # One writer thread and at most one pending write: a slow disk delays the next save, it
+        # doesn't pile up snapshots in memory
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def _load_index(self):
+        index_path = os.path.join(self.checkpoint_dir, INDEX_NAME)
+        if not os.path.exists(index_path):
+            return []
+        with open(index_path) as file:
+            return json.load(file)
+
+    def _save_index(self):
+        index_tmp = os.path.join(self.checkpoint_dir, INDEX_NAME + '.tmp')
+        with open(index_tmp, 'w') as file:
+            json.dump(self.entries, file, indent=2)
+        os.replace(index_tmp, os.path.join(self.checkpoint_dir, INDEX_NAME))
+
+    def _path(self, entry):
+        return os.path.join(self.checkpoint_dir, entry['file'])
+
+    def _write(self, state, entry):
+        path = self._path(entry)
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+        self.entries = [e for e in self.entries if e['file'] != entry['file']] + [entry]
+        by_epoch = sorted(self.entries, key=lambda e: e['epoch'])
+        keep = by_epoch[-self.keep_last:] if self.keep_last else []
+        with_metric = [e for e in self.entries if e['metric'] is not None]
+        keep += sorted(with_metric, key=lambda e: e['metric'])[:self.keep_best]
+        keep_files = {e['file'] for e in keep}
+
+        removed = [e for e in self.entries if e['file'] not in keep_files]
+        self.entries = [e for e in by_epoch if e['file'] in keep_files]
+        self._save_index()
+        for e in removed:
+            if os.path.exists(self._path(e)):
+                os.remove(self._path(e))
+        return path
+
+    # Snapshot state (a dict of state dicts, tensors and plain values) and write it in the
+    # background as the checkpoint of epoch. metric (lower is better) ranks the best checkpoints.
+    def save(self, state, epoch, metric=None):
+        snapshot = snapshot_to_cpu(state)
+        self.wait()
+        entry = {"file": f"epoch_{epoch:04d}.pth", "epoch": epoch,
+                 "metric": None if metric is None else float(metric)}
+        self._pending = self._executor.submit(self._write, snapshot, entry)
+        return self._pending
+
+    # Block until the pending write is done (re-raises its error, if any)
+    def wait(self):
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            return pending.result()
+        return None
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+    def latest(self):
+        if not self.entries:
+            return None
+        return self._path(max(self.entries, key=lambda e: e['epoch']))
+
+    def best(self):
+        with_metric = [e for e in self.entries if e['metric'] is not None]
+        if not with_metric:
+            return None
+        return self._path(min(with_metric, key=lambda e: e['metric']))
+
+    # Load a checkpoint (default the latest) to CPU, None if there is none
+    def load(self, path=None):
+        self.wait()
+        path = self.latest() if path is None else path
+        if path is None:
+            return None
+        return torch.load(path, map_location='cpu', weights_only=False)
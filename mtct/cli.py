@@ -0,0 +1,365 @@
+"""Command line interface of the pipeline.
+
+    python -m mtct preprocess --data-root /data/set_1 --store-dir scaled_store
+    python -m mtct train --store-dir scaled_store --model scratch --checkpoint models/model1.pth
+    torchrun --nproc-per-node 2 -m mtct train --distributed --store-dir scaled_store --checkpoint models/model1.pth
+    python -m mtct evaluate --store-dir scaled_store --model scratch --checkpoint models/model1.pth
+    python -m mtct predict --model scratch --checkpoint models/model1.pth --output-dir masks /data/new/case_*
+    python -m mtct predict --model scratch --checkpoint models/model1.pth --output-dir masks --watch /data/incoming
+    python -m mtct export --model scratch --checkpoint models/model1.pth --output models/model1.pt --quantize
+
+Every subcommand only imports the modules it needs, so e.g. evaluate never loads SimpleITK and
+--help does not import torch at all. The data root defaults to $MTCT_DATA_ROOT.
+"""
+
+import argparse
+import os
+import sys
+
+# Same as mtct.models.MODEL_NAMES, repeated so that building the parser doesn't import torch/monai
+MODEL_CHOICES = ('scratch', 'last_layer', 'last_two_layers')
+
+def _add_model_arguments(parser, checkpoint_required=True):
+    parser.add_argument('--model', choices=MODEL_CHOICES, default='scratch',
+                        help="scratch = YourModel, last_layer / last_two_layers = fine-tuned spleen UNet")
+    parser.add_argument('--checkpoint', required=checkpoint_required, help="model checkpoint (.pth)")
+    parser.add_argument('--num-classes', type=int, default=30)
+    parser.add_argument('--device', default=None, help="torch device, default cuda if available")
+
+def _device(args):
+    import torch
+
+    if args.device is not None:
+        return torch.device(args.device)
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+def _load_trained_model(args, device):
+    from mtct.models import build_model
+    from mtct.training import save_load_model
+
+    # The weights come from the checkpoint, no need to download the pretrained bundle
+    model = build_model(args.model, num_output_channels=args.num_classes, load_pretrained=False, device=device)
+    save_load_model(model, None, 'load', model_name=os.path.basename(args.checkpoint),
+                    model_dir=os.path.dirname(args.checkpoint) or '.')
+    return model
+
+def _profiler(args, device):
+    if not (args.profile or args.trace_dir or args.tensorboard_dir):
+        return None
+    from mtct.profiling import StepProfiler
+
+    return StepProfiler(device, trace_dir=args.trace_dir)
+
+def _export_profile(args, profiler):
+    if profiler is None:
+        return
+    if args.profile:
+        profiler.export_json(args.profile)
+    if args.tensorboard_dir:
+        profiler.write_tensorboard(args.tensorboard_dir)
+
+def preprocess(args):
+    from mtct.data import list_case_folders, load_data_parallel
+    from mtct.labels import label_order
+    from mtct.normalization import normalize_case
+    from mtct.store import write_dataset_store
+
+    reference_size = (args.size,) * 3
+    if args.index:
+        from mtct.index import build_case_index, load_case_index, refresh_case_index
+
+        # The index is built once and reused; only new or changed case folders are indexed again
+        if os.path.exists(args.index) and not args.rebuild_index:
+            index = refresh_case_index(load_case_index(args.index), args.data_root, index_path=args.index)
+        else:
+            index = build_case_index(args.data_root, label_order, index_path=args.index)
+        case_folders = index['cases']
+    else:
+        case_folders = list_case_folders(args.data_root)
+    if args.cache_dir:
+        from mtct.cache import PreprocessingCache, load_cases_cached
+
+        cache = PreprocessingCache(args.cache_dir, max_bytes=args.cache_max_gb * 2**30 if args.cache_max_gb else None)
+        # Recomputed cases are read back memory-mapped like the cache hits, so the cohort isn't held in RAM
+        loaded_data, _ = load_cases_cached(case_folders, cache, reference_size=reference_size, label_order=label_order,
+                                           num_workers=args.workers, mmap_mode='r')
+    else:
+        loaded_data, _ = load_data_parallel(case_folders, num_workers=args.workers, reference_size=reference_size,
+                                            label_order=label_order)
+
+    # Normalized one case at a time while the store is written
+    scaled_cases = (normalize_case(data, modes=tuple(args.normalization), reference_size=reference_size)
+                    for data in loaded_data)
+    write_dataset_store(scaled_cases, args.store_dir, image_dtype=args.image_dtype)
+
+def train(args):
+    import torch
+
+    from mtct.distributed import (cleanup_distributed, get_rank, init_distributed, is_main_process,
+                                  main_process_first, make_distributed_sampler)
+    from mtct.loader import make_data_loader
+    from mtct.models import MODEL_LEARNING_RATES, build_model
+    from mtct.store import split_store
+    from mtct.training import save_load_model, train_model_with_early_stopping
+
+    if args.distributed:
+        _, _, device = init_distributed(backend=args.backend)
+    else:
+        device = _device(args)
+    train_dataset, _ = split_store(args.store_dir, test_size=args.test_size, random_state=args.seed,
+                                   label_format=args.label_format)
+    # Rank 0 downloads the pretrained bundle, DDP then copies its weights to the other ranks
+    with main_process_first():
+        model = build_model(args.model, num_output_channels=args.num_classes, device=device)
+    if args.checkpoint_levels or args.dice_chunk_size:
+        from mtct.memory import enable_memory_saving
+
+        checkpoint_levels = args.checkpoint_levels if args.checkpoint_levels == 'all' else int(args.checkpoint_levels or 0)
+        enable_memory_saving(model, checkpoint_levels=checkpoint_levels, dice_chunk_size=args.dice_chunk_size)
+    trained_module = model
+    if args.feature_store:
+        from mtct.features import FeatureTail, freeze_backbone, write_feature_store
+        from mtct.store import MemmapCaseDataset
+
+        if args.model == 'scratch':
+            raise SystemExit("--feature-store only applies to the fine-tuned models")
+        # The frozen backbone runs once per case, the epochs only train final_conv
+        freeze_backbone(model)
+        with main_process_first():
+            if is_main_process():
+                write_feature_store(model, train_dataset, args.feature_store, device)
+        train_dataset = MemmapCaseDataset(args.feature_store, label_format=args.label_format)
+        trained_module = FeatureTail(model)
+    if args.shared_memory:
+        from mtct.shared import consolidate_cases
+
+        train_dataset = consolidate_cases(train_dataset, label_format=args.label_format)
+
+    if args.patch_size:
+        from mtct.sampling import PatchDataset
+
+        train_dataset = PatchDataset(train_dataset, patch_size=(args.patch_size,) * 3, patches_per_case=args.patches_per_case)
+    sampler = make_distributed_sampler(train_dataset, shuffle=True, seed=args.seed) if args.distributed else None
+    train_loader = make_data_loader(train_dataset, batch_size=args.batch_size, num_workers=args.workers, shuffle=True,
+                                    sampler=sampler)
+
+    lr = args.lr if args.lr is not None else MODEL_LEARNING_RATES[args.model]
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=1e-5)
+    lr_scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=10)
+
+    augmentation = None
+    if args.augment:
+        from mtct.augmentation import BatchAugmentation
+
+        augmentation = BatchAugmentation(seed=args.seed + get_rank())
+
+    checkpoint_manager = None
+    if args.checkpoint_dir:
+        from mtct.checkpoint import CheckpointManager
+
+        checkpoint_manager = CheckpointManager(args.checkpoint_dir, keep_last=args.keep_last, keep_best=args.keep_best)
+
+    profiler = _profiler(args, device)
+    train_model_with_early_stopping(trained_module, train_loader, optimizer, lr_scheduler, device, epochs=args.epochs,
+                                    patience=args.patience, accumulation_steps=args.accumulation_steps,
+                                    amp_dtype=args.amp_dtype, channels_last=args.channels_last,
+                                    compile_model=args.compile, log_interval=args.log_interval,
+                                    checkpoint_manager=checkpoint_manager, resume=not args.no_resume,
+                                    augmentation=augmentation, profiler=profiler)
+    if checkpoint_manager is not None:
+        checkpoint_manager.close()
+    if is_main_process():
+        _export_profile(args, profiler)
+        save_load_model(model, optimizer, 'save', model_name=os.path.basename(args.checkpoint),
+                        model_dir=os.path.dirname(args.checkpoint) or '.')
+    cleanup_distributed()
+
+def evaluate(args):
+    import json
+
+    from mtct.evaluation import test_model
+    from mtct.loader import make_data_loader
+    from mtct.store import split_store
+
+    device = _device(args)
+    _, test_dataset = split_store(args.store_dir, test_size=args.test_size, random_state=args.seed,
+                                  label_format=args.label_format)
+    if args.shared_memory:
+        from mtct.shared import consolidate_cases
+
+        test_dataset = consolidate_cases(test_dataset, label_format=args.label_format)
+    test_loader = make_data_loader(test_dataset, batch_size=args.batch_size, num_workers=args.workers, shuffle=False)
+    model = _load_trained_model(args, device)
+
+    slice_sink = None
+    if args.slices_dir:
+        from mtct.visualization import SliceSink
+
+        slice_sink = SliceSink(args.slices_dir, max_samples=args.max_slices)
+
+    roi_size = (args.roi_size,) * 3 if args.roi_size else None
+    profiler = _profiler(args, device)
+    results = test_model(model, test_loader, model.loss_function, device, num_output_channels=args.num_classes,
+                         threshold=args.threshold, roi_size=roi_size, include_hd95=args.hd95, slice_sink=slice_sink,
+                         profiler=profiler)
+    _export_profile(args, profiler)
+    if slice_sink is not None:
+        slice_sink.close()
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+def export(args):
+    from mtct.export import export_model
+
+    model = _load_trained_model(args, _device(args))
+    export_model(model, args.output, example_size=(args.size,) * 3, fuse=not args.no_fuse, quantize=args.quantize)
+
+def predict(args):
+    import json
+
+    from mtct.service import PredictionService, watch_case_folders
+
+    if args.exported:
+        import torch
+
+        from mtct.export import CpuSegmenter
+
+        device = torch.device('cpu')
+        model = CpuSegmenter(args.checkpoint, num_threads=args.threads)
+    else:
+        device = _device(args)
+        model = _load_trained_model(args, device)
+    spacing = tuple(args.spacing) if args.spacing else None
+    # Whole-volume models saw every case squashed to --size by load_data; --native / --spacing keep the CT grid
+    reference_size = None if args.native or spacing else (args.size,) * 3
+    roi_size = (args.roi_size or args.size,) * 3
+
+    service = PredictionService(model, args.output_dir, device, roi_size=roi_size, overlap=args.overlap,
+                                sw_batch_size=args.sw_batch_size, threshold=args.threshold,
+                                reference_size=reference_size, spacing=spacing,
+                                num_readers=args.readers, num_writers=args.writers, queue_size=args.queue_size)
+    if args.watch:
+        case_folders = watch_case_folders(args.watch, poll_interval=args.poll_interval, idle_timeout=args.idle_timeout)
+    else:
+        case_folders = args.case_folders
+    stats = service.run(case_folders)
+    if args.stats:
+        with open(args.stats, 'w') as file:
+            json.dump(stats, file, indent=2)
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='mtct', description="CT/MR head-and-neck segmentation pipeline")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_preprocess = subparsers.add_parser('preprocess', help="load, resize and normalize the cases into a dataset store")
+    parser_preprocess.add_argument('--data-root', default=os.environ.get('MTCT_DATA_ROOT'), required='MTCT_DATA_ROOT' not in os.environ,
+                                   help="folder with one subfolder of NRRD files per case (default $MTCT_DATA_ROOT)")
+    parser_preprocess.add_argument('--store-dir', default='scaled_store')
+    parser_preprocess.add_argument('--index', help="case index (JSON) to reuse, built from --data-root if it doesn't exist")
+    parser_preprocess.add_argument('--rebuild-index', action='store_true')
+    parser_preprocess.add_argument('--cache-dir', help="per-case preprocessing cache, only new or changed cases are recomputed")
+    parser_preprocess.add_argument('--cache-max-gb', type=float)
+    parser_preprocess.add_argument('--size', type=int, default=128, help="reference_size edge length")
+    parser_preprocess.add_argument('--normalization', nargs=2, default=('minmax', 'minmax'), metavar=('CT', 'MR'),
+                                   choices=('minmax', 'ct_window', 'mr_percentile'))
+    parser_preprocess.add_argument('--image-dtype', choices=('float16', 'float32'), default='float16')
+    parser_preprocess.add_argument('--workers', type=int, default=None)
+    parser_preprocess.set_defaults(func=preprocess)
+
+    for name, func, help_text in (('train', train, "train a model on the train split of a store"),
+                                  ('evaluate', evaluate, "evaluate a trained model on the test split of a store")):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('--store-dir', default='scaled_store')
+        sub.add_argument('--test-size', type=float, default=0.2)
+        sub.add_argument('--seed', type=int, default=42)
+        sub.add_argument('--batch-size', type=int, default=2)
+        sub.add_argument('--workers', type=int, default=2)
+        sub.add_argument('--label-format', choices=('dense', 'bitfield'), default='dense',
+                         help="bitfield: batch the labels as int32 bitfields and expand them on the device")
+        sub.add_argument('--shared-memory', action='store_true',
+                         help="read the split into shared memory once, the loader workers read from there")
+        _add_model_arguments(sub)
+        sub.add_argument('--profile', help="record per-step phase timings and memory, write them as JSON")
+        sub.add_argument('--trace-dir', help="write a torch.profiler trace of a few steps here")
+        sub.add_argument('--tensorboard-dir', help="write the per-step timings as TensorBoard scalars here")
+        sub.set_defaults(func=func)
+        if name == 'train':
+            sub.add_argument('--epochs', type=int, default=250)
+            sub.add_argument('--patience', type=int, default=20)
+            sub.add_argument('--lr', type=float, help="default: the learning rate of the model variant")
+            sub.add_argument('--patch-size', type=int, help="train on random patches of this edge length")
+            sub.add_argument('--patches-per-case', type=int, default=4)
+            sub.add_argument('--feature-store', help="fine-tuned models: cache the frozen backbone features here "
+                                                      "and only train final_conv")
+            sub.add_argument('--augment', action='store_true',
+                             help="random flips, affine transforms and intensity jitter on the device (seeded with --seed)")
+            sub.add_argument('--accumulation-steps', type=int, default=1, help="batches per optimizer step")
+            sub.add_argument('--amp-dtype', choices=('auto', 'float16', 'bfloat16'), default='auto',
+                             help="autocast dtype, auto = float16 on CUDA and no autocast on CPU")
+            sub.add_argument('--channels-last', action='store_true', help="use the channels_last_3d memory format")
+            sub.add_argument('--compile', action='store_true', help="torch.compile the model")
+            sub.add_argument('--checkpoint-dir', help="checkpoint every epoch here, and resume from the latest checkpoint")
+            sub.add_argument('--keep-last', type=int, default=2)
+            sub.add_argument('--keep-best', type=int, default=1)
+            sub.add_argument('--no-resume', action='store_true', help="ignore existing checkpoints in --checkpoint-dir")
+            sub.add_argument('--log-interval', type=int, help="also print the running loss every N steps")
+            sub.add_argument('--checkpoint-levels', help="recompute the activations of the N highest-resolution UNet "
+                                                          "levels in the backward pass ('all': every block)")
+            sub.add_argument('--dice-chunk-size', type=int, help="compute the Dice loss this many channels at a time")
+            sub.add_argument('--distributed', action='store_true',
+                             help="data-parallel training over the processes started by torchrun")
+            sub.add_argument('--backend', choices=('gloo', 'nccl'), help="default nccl with CUDA, gloo otherwise")
+        else:
+            sub.add_argument('--threshold', type=float, default=0.5)
+            sub.add_argument('--roi-size', type=int, help="evaluate with sliding windows of this edge length")
+            sub.add_argument('--hd95', action='store_true', help="also compute the Hausdorff95 distance")
+            sub.add_argument('--slices-dir', help="save slice figures of a few test samples here")
+            sub.add_argument('--max-slices', type=int, default=6)
+            sub.add_argument('--output', help="write the metrics as JSON")
+
+    parser_export = subparsers.add_parser('export', help="export a trained model as TorchScript (.pt) or ONNX (.onnx)")
+    _add_model_arguments(parser_export)
+    parser_export.add_argument('--output', required=True, help="artifact path, the suffix selects the format")
+    parser_export.add_argument('--size', type=int, default=128, help="edge length of the example input used for tracing")
+    parser_export.add_argument('--quantize', action='store_true', help="int8 conv weights (TorchScript only)")
+    parser_export.add_argument('--no-fuse', action='store_true', help="keep the 1x1 output convs separate")
+    parser_export.set_defaults(func=export)
+
+    parser_predict = subparsers.add_parser('predict', help="predict full-resolution NRRD masks for case folders")
+    _add_model_arguments(parser_predict)
+    parser_predict.add_argument('--exported', action='store_true',
+                                help="--checkpoint is an artifact of 'mtct export', run it on the CPU")
+    parser_predict.add_argument('--threads', type=int, help="CPU threads for --exported")
+    parser_predict.add_argument('case_folders', nargs='*')
+    parser_predict.add_argument('--watch', metavar='INPUT_DIR', help="predict every case folder that appears in INPUT_DIR")
+    parser_predict.add_argument('--poll-interval', type=float, default=10.0)
+    parser_predict.add_argument('--idle-timeout', type=float, help="with --watch, stop after this many seconds without a new case")
+    parser_predict.add_argument('--readers', type=int, default=2, help="threads reading and preprocessing cases")
+    parser_predict.add_argument('--writers', type=int, default=2, help="threads writing masks")
+    parser_predict.add_argument('--queue-size', type=int, default=2, help="prepared cases waiting per stage")
+    parser_predict.add_argument('--stats', help="write the per-stage throughput and latency as JSON")
+    parser_predict.add_argument('--output-dir', required=True)
+    parser_predict.add_argument('--size', type=int, default=128,
+                                help="reference_size edge length the cases are squashed to, like in preprocess")
+    parser_predict.add_argument('--roi-size', type=int, help="sliding window edge length, default --size")
+    parser_predict.add_argument('--overlap', type=float, default=0.25)
+    parser_predict.add_argument('--sw-batch-size', type=int, default=4)
+    parser_predict.add_argument('--threshold', type=float, default=0.5)
+    parser_predict.add_argument('--native', action='store_true',
+                                help="run on the native CT grid instead of --size (models trained on patches)")
+    parser_predict.add_argument('--spacing', type=float, nargs=3, metavar=('X', 'Y', 'Z'),
+                                help="run on the CT grid resampled to this spacing instead of --size")
+    parser_predict.set_defaults(func=predict)
+
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'predict' and not args.case_folders and not args.watch:
+        parser.error("predict needs case folders or --watch")
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
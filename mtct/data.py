@@ -0,0 +1,257 @@
+"""Dataloading and resampling of the CT/MR/label NRRD cases.
+
+Kept in an importable module so the functions can be shipped to worker processes.
+"""
+
+import gc
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import SimpleITK as sitk
+
+from mtct.index import index_case, is_complete
+from mtct.labels import label_order
+
+# stages reported by load_data when a timings dict is passed in
+TIMING_STAGES = ('read', 'resample', 'to_array')
+
+#resize Images
+
+def resize_image(image, reference_size):
+    original_size = np.array(image.GetSize())
+    original_spacing = np.array(image.GetSpacing())
+
+    new_size = reference_size
+    new_spacing = original_spacing * (original_size / new_size)
+    new_spacing = tuple(new_spacing)
+
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize(new_size)
+    resampler.SetOutputSpacing(new_spacing)
+    resampler.SetOutputOrigin(image.GetOrigin())
+    resampler.SetOutputDirection(image.GetDirection())
+    resampled_image = resampler.Execute(image)
+
+    return resampled_image
+
+def _is_binary_uint8(image):
+    if image.GetPixelID() != sitk.sitkUInt8:
+        return False
+    statistics = sitk.MinimumMaximumImageFilter()
+    statistics.Execute(image)
+    return statistics.GetMaximum() <= 1
+
+# Same grid as reference, within the coordinate/direction tolerance sitk.Compose checks against
+def _same_geometry(image, reference, tolerance=1e-6):
+    coordinate_tolerance = tolerance * reference.GetSpacing()[0]
+    return (image.GetSize() == reference.GetSize()
+            and np.allclose(image.GetSpacing(), reference.GetSpacing(), rtol=0, atol=coordinate_tolerance)
+            and np.allclose(image.GetOrigin(), reference.GetOrigin(), rtol=0, atol=coordinate_tolerance)
+            and np.allclose(image.GetDirection(), reference.GetDirection(), rtol=0, atol=tolerance))
+
+# Resample all label masks of a case onto one reference grid in a single pass.
+# When the masks share the geometry of the first one, they are composed into one VectorUInt8
+# image (one component per mask, binarised unless they already are binary UInt8), resampled
+# once with nearest-neighbour interpolation and split into a packed (num_labels, D, H, W) uint8
+# array. Otherwise every mask is resampled onto the grid of the first one on its own.
+# A list of masks is emptied as they are consumed, so the full-resolution masks are released
+# as soon as possible; pass a list the caller no longer needs.
+def resize_label_stack(labels, reference_size):
+    if not isinstance(labels, list):
+        labels = list(labels)
+    num_labels = len(labels)
+    reference = labels[0]
+    original_size = np.array(reference.GetSize())
+    original_spacing = np.array(reference.GetSpacing())
+    new_spacing = tuple(original_spacing * (original_size / np.array(reference_size)))
+
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize(reference_size)
+    resampler.SetOutputSpacing(new_spacing)
+    resampler.SetOutputOrigin(reference.GetOrigin())
+    resampler.SetOutputDirection(reference.GetDirection())
+    resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+    resampler.SetDefaultPixelValue(0)
+    # sitk arrays are indexed (z, y, x), i.e. reversed with respect to GetSize()
+    volume_shape = tuple(reference_size)[::-1]
+
+    if not all(_same_geometry(label, reference) for label in labels):
+        resampler.SetOutputPixelType(sitk.sitkUInt8)
+        stack = np.empty((num_labels,) + volume_shape, dtype=np.uint8)
+        for i in range(num_labels):
+            stack[i] = sitk.GetArrayViewFromImage(resampler.Execute(labels[i])) != 0
+            labels[i] = None
+        labels.clear()
+        return stack
+
+    # label != 0 is a binary UInt8 image, so every component of the vector image is a mask
+    for i, label in enumerate(labels):
+        if not _is_binary_uint8(label):
+            labels[i] = label != 0
+    del reference, label
+    composed = sitk.Compose(labels)
+    labels.clear()
+    resampled = resampler.Execute(composed)
+    del composed
+
+    # sitk arrays of vector images are indexed (z, y, x, component); the reshape keeps the
+    # component axis that sitk drops for a single mask
+    stack = sitk.GetArrayViewFromImage(resampled).reshape(volume_shape + (num_labels,))
+    return np.ascontiguousarray(np.moveaxis(stack, -1, 0))
+
+# Folder of a case given as folder or as case index entry
+def case_folder_of(case):
+    return case['case_folder'] if isinstance(case, dict) else case
+
+# Case folders (one per patient) directly below data_root, sorted by name
+def list_case_folders(data_root):
+    with os.scandir(data_root) as entries:
+        return sorted(entry.path for entry in entries if entry.is_dir())
+
+#Dataloading function to load Mri and CT Data
+# case_folder is a case folder or its entry of a case index (mtct.index), which saves listing
+# the folder again. The label files are mapped to their label_order channel by name (exactly,
+# see mtct.index.label_channel); without label_order they are loaded in name order.
+# If a dict is passed as timings, the seconds spent per stage (see TIMING_STAGES) are added to it.
+def load_data(case_folder, reference_size=(128, 128, 128), label_order=None, timings=None):
+    if timings is None:
+        timings = {}
+    for stage in TIMING_STAGES:
+        timings.setdefault(stage, 0.0)
+
+    try:
+        if isinstance(case_folder, dict):
+            entry = case_folder
+            case_folder = entry['case_folder']
+        else:
+            entry = index_case(case_folder, label_order, with_geometry=False)
+        labels_for_image = entry['labels']
+
+        if is_complete(entry) and len(labels_for_image) == 30:
+            start = time.perf_counter()
+            ct_image = sitk.ReadImage(entry['ct'])
+            mr_image = sitk.ReadImage(entry['mr'])
+            loaded_labels = [sitk.ReadImage(label_file) for label_file in labels_for_image]
+            timings['read'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            ct_image = resize_image(ct_image, reference_size)
+            mr_image = resize_image(mr_image, reference_size)
+            # (30, D, H, W) uint8, already binary
+            loaded_labels = resize_label_stack(loaded_labels, reference_size)
+            timings['resample'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            # sitk arrays are (z, y, x), so the volume shape is reference_size reversed
+            ct_image = sitk.GetArrayFromImage(ct_image).reshape(tuple(reference_size)[::-1])
+            mr_image = sitk.GetArrayFromImage(mr_image).reshape(tuple(reference_size)[::-1])
+            image = np.array([ct_image, mr_image])
+            timings['to_array'] += time.perf_counter() - start
+
+            return {"image": image, "labels": loaded_labels}
+        else:
+            missing = [name for name, path in zip(label_order or range(len(labels_for_image)), labels_for_image) if path is None]
+            if entry['ct'] is None or entry['mr'] is None:
+                reason = "CT or MR file is missing"
+            elif missing:
+                reason = f"no label file for {missing}"
+            else:
+                reason = f"{len(labels_for_image)} label files instead of 30"
+            print(f"Skipping case {case_folder}: {reason}; unmatched files: {entry['unmatched']}")
+    except Exception as e:
+        print(f"Error loading data for case: {case_folder}")
+        print(f"Exception thrown: {e}")
+    return None
+
+#load data in batches
+def load_data_in_batches(case_folders, batch_size=3):
+    loaded_data_resized = []
+
+    for i in range(0, len(case_folders), batch_size):
+        batch_folders = case_folders[i:i + batch_size]
+        batch_data = []
+        for folder in batch_folders:
+            data = load_data(folder, label_order=label_order)
+            if data is not None:
+                batch_data.append(data)
+            else:
+                print(f"Failed to load data from folder: {folder}")
+
+        loaded_data_resized.extend(batch_data)
+        print(f"Processed {len(batch_data)} cases. Total processed: {len(loaded_data_resized)}")
+        del batch_data
+        gc.collect()
+
+    return loaded_data_resized
+
+#Parallel loading
+
+# Every worker process resamples one case at a time, so keep ITK itself single threaded
+# to avoid oversubscribing the cores.
+def _init_ingestion_worker(itk_threads):
+    sitk.ProcessObject_SetGlobalDefaultNumberOfThreads(itk_threads)
+
+def _load_case_timed(case_folder, reference_size, label_order):
+    timings = {}
+    start = time.perf_counter()
+    data = load_data(case_folder, reference_size=reference_size, label_order=label_order, timings=timings)
+    timings['total'] = time.perf_counter() - start
+    return data, timings
+
+# Decode and resample cases in a process pool.
+# At most max_in_flight cases are submitted at a time (default 2 * num_workers), which bounds
+# the memory held by finished-but-unconsumed results. Cases come back in the order of
+# case_folders, failed cases are dropped like in load_data_in_batches (or kept as None with keep_failed=True).
+# case_folders may also be the entries of a case index (mtct.index).
+# on_result(index, data) is called for every loaded case as soon as it is done (e.g. to store it
+# right away); its return value takes the place of data in the results.
+# Returns (loaded_data, stats) where stats holds the summed per-stage timings and the wall time.
+def load_data_parallel(case_folders, num_workers=None, max_in_flight=None, reference_size=(128, 128, 128),
+                       label_order=label_order, itk_threads=1, keep_failed=False, on_result=None):
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+    if max_in_flight < 1:
+        raise ValueError("max_in_flight must be at least 1")
+
+    stage_totals = {stage: 0.0 for stage in TIMING_STAGES + ('total',)}
+    results = [None] * len(case_folders)
+    wall_start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_ingestion_worker,
+                             initargs=(itk_threads,)) as executor:
+        pending = {}
+        next_index = 0
+        while next_index < len(case_folders) or pending:
+            while next_index < len(case_folders) and len(pending) < max_in_flight:
+                future = executor.submit(_load_case_timed, case_folders[next_index], reference_size, label_order)
+                pending[future] = next_index
+                next_index += 1
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                data, timings = future.result()
+                for stage, seconds in timings.items():
+                    stage_totals[stage] += seconds
+                if data is None:
+                    print(f"Failed to load data from folder: {case_folder_of(case_folders[index])}")
+                elif on_result is not None:
+                    data = on_result(index, data)
+                results[index] = data
+
+    loaded_data_resized = [data for data in results if data is not None or keep_failed]
+    stats = {
+        "num_cases": sum(data is not None for data in results),
+        "num_workers": num_workers,
+        "wall_time": time.perf_counter() - wall_start,
+        "stage_times": stage_totals,
+    }
+    print(f"Processed {stats['num_cases']} cases with {num_workers} workers in {stats['wall_time']:.1f}s "
+          f"(read {stage_totals['read']:.1f}s, resample {stage_totals['resample']:.1f}s, "
+          f"to_array {stage_totals['to_array']:.1f}s summed over workers)")
+
+    return loaded_data_resized, stats
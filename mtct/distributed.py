@@ -0,0 +1,78 @@
+"""Multi-process data-parallel training (DistributedDataParallel).
+
+Every process trains a replica of the model on its share of the cases (DistributedSampler) and
+the gradients are averaged across processes in the backward pass. train_model_with_early_stopping
+switches to this mode by itself once a process group is initialized: it wraps the model in DDP,
+reshuffles the sampler every epoch, averages the epoch loss over all processes (so every rank
+takes the same early-stopping decision and steps its LR scheduler in lockstep) and only logs
+and checkpoints on rank 0.
+
+Launch with torchrun, on CPU with the gloo backend (e.g. one process per socket):
+
+    torchrun --nproc-per-node 2 -m mtct train --distributed --store-dir scaled_store ...
+"""
+
+import contextlib
+import os
+
+import torch
+import torch.distributed as dist
+from torch.utils.data.distributed import DistributedSampler
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+# Initialize the process group from the torchrun environment (RANK, WORLD_SIZE, LOCAL_RANK,
+# MASTER_ADDR, MASTER_PORT). backend defaults to nccl with CUDA and gloo otherwise. On CPU the
+# cores are split between the local processes unless num_threads is given.
+# Returns (rank, world_size, device).
+def init_distributed(backend=None, num_threads=None):
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    use_cuda = torch.cuda.is_available() and backend != 'gloo'
+    backend = backend or ('nccl' if use_cuda else 'gloo')
+    if not is_distributed():
+        dist.init_process_group(backend=backend)
+
+    if use_cuda:
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', get_world_size()))
+        torch.set_num_threads(num_threads or max(1, (os.cpu_count() or 1) // local_world_size))
+    return get_rank(), get_world_size(), device
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+# Rank 0 runs the block first (e.g. to download the pretrained bundle), the others wait for it
+@contextlib.contextmanager
+def main_process_first():
+    if is_distributed() and not is_main_process():
+        dist.barrier()
+    yield
+    if is_distributed() and is_main_process():
+        dist.barrier()
+
+# Sampler giving every rank a disjoint share of dataset, reshuffled per epoch via set_epoch
+def make_distributed_sampler(dataset, shuffle=True, seed=0, drop_last=False):
+    return DistributedSampler(dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle, seed=seed,
+                              drop_last=drop_last)
+
+# Sum of the given numbers over all ranks, as floats (one all_reduce)
+def all_reduce_sum(values, device):
+    if not is_distributed():
+        return [float(value) for value in values]
+    tensor = torch.stack([torch.as_tensor(value, dtype=torch.float64, device=device) for value in values])
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
@@ -0,0 +1,156 @@
+"""Test function and Dice helpers for the trained segmentation models."""
+
+import torch
+
+from mtct.bitfield import dense_labels
+from mtct.labels import label_order as default_label_order
+from mtct.metrics import SegmentationMetrics
+from mtct.profiling import phase_timer
+
+#test function
+def dice_coefficient(predicted, target, threshold=0.6):
+    predicted_binary = (predicted > threshold).float()
+    target_binary = (target > threshold).float()
+
+    intersection = torch.sum(predicted_binary * target_binary)
+    union = torch.sum(predicted_binary) + torch.sum(target_binary)
+    dice = (2.0 * intersection) / (union + 1e-8)
+    return dice
+
+def threshold_mask(probability_map, threshold=0.7):
+    binary_mask = (probability_map > threshold).float()
+    return binary_mask
+
+def _predict(model, inputs, roi_size=None, overlap=0.25, sw_batch_size=4):
+    if roi_size is not None:
+        from mtct.inference import sliding_window_predict
+
+        return sliding_window_predict(model, inputs, roi_size=roi_size, overlap=overlap, sw_batch_size=sw_batch_size)
+    return model(inputs)
+
+# Pass a SliceSink as slice_sink to save slice figures of a few samples, evaluation itself never plots.
+# With roi_size set, every volume is predicted with overlapping, Gaussian-blended sliding windows
+# of that size (sw_batch_size windows per forward pass) instead of one forward pass.
+# A mtct.profiling.StepProfiler records the per-step phase timings and memory.
+def test_model(model, test_loader, loss_function, device, num_output_channels=30, threshold=0.5,
+               roi_size=None, overlap=0.25, sw_batch_size=4, include_iou=True, include_hd95=False, slice_sink=None,
+               profiler=None):
+    model.eval()
+    phase = phase_timer(profiler)
+    # Losses and metrics stay on the device, they are only copied to the host after the last batch
+    total_test_loss = torch.zeros((), device=device)
+    metrics = SegmentationMetrics(num_channels=num_output_channels, threshold=threshold,
+                                  include_iou=include_iou, include_hd95=include_hd95)
+    num_batches = 0
+
+    with torch.no_grad():  # Disable gradient computation during testing
+        if profiler is not None:
+            profiler.start()
+        for batch_idx, batch in enumerate(test_loader):
+            if profiler is not None:
+                profiler.start_step()
+            with phase('transfer'):
+                inputs = batch['images'].to(device, non_blocking=True).float()
+                targets = dense_labels(batch['labels'].to(device, non_blocking=True), num_output_channels)
+
+            with phase('forward'):
+                outputs = _predict(model, inputs, roi_size, overlap, sw_batch_size)
+
+                # Calculate dice loss for the entire batch
+                total_test_loss += loss_function(outputs, targets).detach()
+                num_batches += 1
+
+                # Per-channel Dice loss, Dice coefficient (and IoU/HD95) for all channels at once,
+                # also returns the thresholded predictions
+                binary_outputs = metrics.update(outputs, targets)
+
+            # Only the mid slices of a few samples are kept, the figures are rendered off the hot path
+            if slice_sink is not None and not slice_sink.full:
+                slice_sink.add(inputs, targets, binary_outputs, f"Batch {batch_idx + 1}")
+            if profiler is not None:
+                profiler.end_step(inputs.shape[0])
+
+    if profiler is not None:
+        profiler.stop()
+        profiler.print_summary()
+
+    # Calculate and print average statistics across all batches
+    average_test_loss = total_test_loss.item() / num_batches
+    print(f"Overall Test Loss: {average_test_loss}")
+
+    results = metrics.compute()
+    results['loss'] = average_test_loss
+    print(f"Average Dice Loss per Channel: {results['dice_loss']}")
+    print(f"Average Dice Coefficient per Channel: {results['dice']}")
+    if include_iou:
+        print(f"Average IoU per Channel: {results['iou']}")
+    if include_hd95:
+        print(f"Average Hausdorff95 per Channel: {results['hd95']}")
+
+    return results
+
+# Evaluate several models (a dict name -> model) in one pass over test_loader: every batch is
+# copied to the device once and run through all models. With ensemble=True the mean of the
+# models' sigmoid probabilities is evaluated as well, under the name 'ensemble'. Each model is
+# scored with its own loss_function attribute unless loss_function is given.
+# slice_sinks optionally maps model names to SliceSinks. Prints a per-structure comparison of
+# the Dice coefficient and returns {name: results} with the results of test_model.
+def test_models(models, test_loader, device, loss_function=None, num_output_channels=30, threshold=0.5,
+                roi_size=None, overlap=0.25, sw_batch_size=4, include_iou=True, include_hd95=False,
+                ensemble=False, slice_sinks=None, label_order=default_label_order):
+    names = list(models) + (['ensemble'] if ensemble else [])
+    slice_sinks = slice_sinks or {}
+    if loss_function is None:
+        losses = {name: model.loss_function for name, model in models.items()}
+    else:
+        losses = dict.fromkeys(models, loss_function)
+    # All models use the same DiceLoss configuration
+    losses['ensemble'] = next(iter(losses.values()))
+
+    total_test_loss = {name: torch.zeros((), device=device) for name in names}
+    metrics = {name: SegmentationMetrics(num_channels=num_output_channels, threshold=threshold,
+                                         include_iou=include_iou, include_hd95=include_hd95) for name in names}
+    num_batches = 0
+
+    for model in models.values():
+        model.eval()
+
+    with torch.no_grad():
+        for batch_idx, batch in enumerate(test_loader):
+            inputs = batch['images'].to(device, non_blocking=True).float()
+            targets = dense_labels(batch['labels'].to(device, non_blocking=True), num_output_channels)
+
+            outputs = {name: _predict(model, inputs, roi_size, overlap, sw_batch_size) for name, model in models.items()}
+            if ensemble:
+                probabilities = torch.stack([torch.sigmoid(o.float()) for o in outputs.values()]).mean(dim=0)
+                outputs['ensemble'] = torch.logit(probabilities, eps=1e-6)
+
+            for name, model_outputs in outputs.items():
+                total_test_loss[name] += losses[name](model_outputs, targets).detach()
+                binary_outputs = metrics[name].update(model_outputs, targets)
+                slice_sink = slice_sinks.get(name)
+                if slice_sink is not None and not slice_sink.full:
+                    slice_sink.add(inputs, targets, binary_outputs, f"{name} batch {batch_idx + 1}")
+            num_batches += 1
+
+    results = {}
+    for name in names:
+        results[name] = metrics[name].compute()
+        results[name]['loss'] = total_test_loss[name].item() / num_batches
+        print(f"{name}: Overall Test Loss: {results[name]['loss']}")
+
+    print(format_comparison_table(results, label_order, metric='dice'))
+    return results
+
+# Table with one row per structure (and the mean) and one column per model of a test_models metric
+def format_comparison_table(results, label_order=default_label_order, metric='dice'):
+    names = list(results)
+    name_width = max(len(label) for label in list(label_order) + ['mean'])
+    column_width = max(10, max(len(name) for name in names))
+    lines = [f"{metric:<{name_width}}  " + "  ".join(f"{name:>{column_width}}" for name in names)]
+    for channel, label in enumerate(label_order):
+        lines.append(f"{label:<{name_width}}  " +
+                     "  ".join(f"{results[name][metric][channel]:>{column_width}.4f}" for name in names))
+    means = [sum(results[name][metric]) / len(results[name][metric]) for name in names]
+    lines.append(f"{'mean':<{name_width}}  " + "  ".join(f"{mean:>{column_width}.4f}" for mean in means))
+    return "\n".join(lines)
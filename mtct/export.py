@@ -0,0 +1,133 @@
+"""Standalone inference artifacts for CPU nodes.
+
+export_model turns a trained model into a file that can be run without mtct.models, monai or
+the spleen bundle: a traced TorchScript module (.pt) or an ONNX graph (.onnx, needs the onnx
+package). Before exporting
+
+- the 1x1 convolutions single_channel_conv and final_conv that UNetWithTwoChannels applies back
+  to back are folded into one Conv3d(2, N) (fuse=True),
+- the Conv3d/ConvTranspose3d layers can be quantized to int8 weights with dynamic activation
+  quantization (quantize=True, TorchScript only; use onnxruntime's own quantization for ONNX).
+
+CpuSegmenter loads either artifact with a fixed number of threads:
+
+    export_model(model, 'model1.pt', example_size=(128, 128, 128), quantize=True)
+    segmenter = CpuSegmenter('model1.pt', num_threads=8)
+    masks = predict_full_resolution(segmenter, case_folder, torch.device('cpu'))
+"""
+
+import copy
+import os
+
+import torch
+from torch import nn
+
+# Conv3d(2, N) equal to final_conv(single_channel_conv(x)) for the 1x1 convs Conv3d(2, 1) and Conv3d(1, N)
+def fuse_pointwise_convs(first, second):
+    fused = nn.Conv3d(first.in_channels, second.out_channels, kernel_size=1)
+    with torch.no_grad():
+        first_weight = first.weight.flatten(1)    # (1, 2)
+        second_weight = second.weight.flatten(1)  # (N, 1)
+        fused.weight.copy_((second_weight @ first_weight).view(fused.weight.shape))
+        fused.bias.copy_(second_weight @ first.bias + second.bias)
+    return fused.to(first.weight.device)
+
+# Input fusion, UNet and the fused output convolution of UNetWithTwoChannels
+class FusedTwoChannelsModel(nn.Module):
+    def __init__(self, model):
+        super(FusedTwoChannelsModel, self).__init__()
+        self.single_channel_conv = model.single_channel_conv
+        self.model = model.model
+        self.final_conv = fuse_pointwise_convs(model.single_channel_conv, model.final_conv)
+
+    def forward(self, inputs):
+        return self.final_conv(self.model(self.single_channel_conv(inputs)))
+
+# Inference copy of model: eval mode, on the CPU, with the back-to-back 1x1 convs fused
+def prepare_for_export(model, fuse=True):
+    model = copy.deepcopy(model).cpu().eval()
+    if fuse and type(model).__name__ == 'UNetWithTwoChannels':
+        model = FusedTwoChannelsModel(model).eval()
+    return model
+
+# int8 weights for every Conv3d/ConvTranspose3d, activations quantized on the fly
+def quantize_convs(model):
+    import torch.ao.nn.quantized.dynamic as nnqd
+    from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+
+    return quantize_dynamic(model, {nn.Conv3d: default_dynamic_qconfig, nn.ConvTranspose3d: default_dynamic_qconfig},
+                            mapping={nn.Conv3d: nnqd.Conv3d, nn.ConvTranspose3d: nnqd.ConvTranspose3d})
+
+# Export model to path as TorchScript ('.pt') or ONNX ('.onnx'), traced with a
+# (1, in_channels, *example_size) input; every example_size dimension must be divisible by 16.
+# Returns the largest absolute difference between the logits of the artifact and of model on
+# the example input, to judge the effect of quantization.
+def export_model(model, path, example_size=(128, 128, 128), in_channels=2, fuse=True, quantize=False,
+                 export_format=None):
+    export_format = export_format or ('onnx' if path.endswith('.onnx') else 'torchscript')
+    reference = copy.deepcopy(model).cpu().eval()
+    model = prepare_for_export(model, fuse=fuse)
+    if quantize:
+        if export_format == 'onnx':
+            raise ValueError("quantize=True is only supported for TorchScript, quantize ONNX models with onnxruntime")
+        model = quantize_convs(model)
+
+    example = torch.rand((1, in_channels) + tuple(example_size))
+    path_dir = os.path.dirname(path)
+    if path_dir:
+        os.makedirs(path_dir, exist_ok=True)
+
+    with torch.no_grad():
+        if export_format == 'torchscript':
+            artifact = torch.jit.freeze(torch.jit.trace(model, example))
+            artifact.save(path)
+            outputs = torch.jit.load(path)(example)
+        elif export_format == 'onnx':
+            dynamic_axes = {'images': {0: 'batch', 2: 'depth', 3: 'height', 4: 'width'},
+                            'logits': {0: 'batch', 2: 'depth', 3: 'height', 4: 'width'}}
+            torch.onnx.export(model, (example,), path, input_names=['images'], output_names=['logits'],
+                              dynamic_axes=dynamic_axes, dynamo=False)
+            outputs = CpuSegmenter(path)(example)
+        else:
+            raise ValueError(f"Unknown export format '{export_format}', expected 'torchscript' or 'onnx'")
+        max_difference = (outputs - reference(example)).abs().max().item()
+
+    print(f"Exported {export_format} model to {path} (max logit difference {max_difference:.4g})")
+    return max_difference
+
+# Runs an exported artifact on the CPU. num_threads sets the intra-op threads (torch.set_num_threads
+# for TorchScript, the session options for ONNX Runtime). Called with a (B, C, D, H, W) float
+# tensor it returns the logits as a tensor, so it can stand in for the model in
+# sliding_window_predict and predict_full_resolution.
+class CpuSegmenter:
+    def __init__(self, path, num_threads=None, interop_threads=None):
+        self.path = path
+        if path.endswith('.onnx'):
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            if interop_threads is not None:
+                options.inter_op_num_threads = interop_threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.module = None
+        else:
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            if interop_threads is not None:
+                torch.set_num_interop_threads(interop_threads)
+            self.session = None
+            self.module = torch.jit.load(path, map_location='cpu')
+            self.module.eval()
+
+    # Exported artifacts are always in inference mode
+    def eval(self):
+        return self
+
+    def __call__(self, inputs):
+        inputs = inputs.detach().to('cpu', torch.float32)
+        if self.session is not None:
+            return torch.from_numpy(self.session.run(None, {'images': inputs.numpy()})[0])
+        with torch.no_grad():
+            return self.module(inputs)
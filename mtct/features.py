@@ -0,0 +1,70 @@
+"""Cached backbone features for fine-tuning only the last layer of the spleen UNet wrappers.
+
+With the input fusion (single_channel_conv) and the pretrained UNet fixed, everything before
+final_conv gives the same output for a case in every epoch. write_feature_store runs that part
+once per case (backbone_features, in eval mode) and writes the result to a dataset store next
+to the labels; FeatureTail then trains final_conv on the memory-mapped features:
+
+    freeze_backbone(model)
+    write_feature_store(model, train_dataset, 'features_store', device)
+    tail = FeatureTail(model)
+    train_loader = make_data_loader(MemmapCaseDataset('features_store'), batch_size=8, shuffle=True)
+    train_model_with_early_stopping(tail, train_loader, optimizer, lr_scheduler, device, epochs=250)
+
+final_conv is shared between the tail and the wrapper, so the trained wrapper is saved as usual.
+Because final_conv is a 1x1 convolution, PatchDataset crops of the feature store are valid too.
+
+Unlike the end-to-end loop, the frozen BatchNorm layers use their running statistics (eval mode)
+instead of the statistics of each batch.
+"""
+
+import numpy as np
+import torch
+from torch import nn
+
+from mtct.bitfield import unpack_label_bits
+from mtct.labels import label_order as default_label_order
+from mtct.store import write_dataset_store
+
+# Freeze everything except final_conv, including the input fusion.
+# For UNetWithTwoChannels this also freezes the UNet, which unfreeze_last_two_layers leaves trainable.
+def freeze_backbone(model):
+    for param in model.parameters():
+        param.requires_grad = False
+    for param in model.final_conv.parameters():
+        param.requires_grad = True
+    return model
+
+def _iter_features(model, cases, device, feature_dtype):
+    model.eval()
+    with torch.no_grad():
+        for data in cases:
+            inputs = torch.as_tensor(np.asarray(data['image'], dtype=np.float32)).unsqueeze(0).to(device)
+            features = model.backbone_features(inputs)[0]
+            labels = np.asarray(data['labels'])
+            if labels.ndim == 3:
+                labels = unpack_label_bits(torch.from_numpy(labels), model.final_conv.out_channels, torch.uint8).numpy()
+            yield {"image": features.to('cpu', torch.float32).numpy().astype(feature_dtype), "labels": labels}
+
+# Run the frozen part of model (a wrapper with backbone_features/final_conv) once over every case
+# of cases (a list of cases or a MemmapCaseDataset) and write the features with the labels to
+# store_dir. Cases are processed one at a time, so only one volume of features is in memory.
+# The label channels keep the label_order of cases. Returns the store manifest.
+def write_feature_store(model, cases, store_dir, device, feature_dtype=np.float16):
+    trainable = [name for name, param in model.named_parameters()
+                 if param.requires_grad and not name.startswith('final_conv.')]
+    if trainable:
+        raise ValueError(f"Cached features need a frozen backbone (see freeze_backbone), trainable: {trainable[0]}")
+    return write_dataset_store(_iter_features(model, cases, device, feature_dtype), store_dir,
+                               image_dtype=feature_dtype, label_order=getattr(cases, 'label_order', default_label_order))
+
+# Trainable tail of a fine-tuning wrapper, to train on cached features instead of images.
+# Shares final_conv (and the loss function) with the wrapper.
+class FeatureTail(nn.Module):
+    def __init__(self, model):
+        super(FeatureTail, self).__init__()
+        self.final_conv = model.final_conv
+        self.loss_function = model.loss_function
+
+    def forward(self, features):
+        return self.final_conv(features)
@@ -0,0 +1,157 @@
+"""Index of the case folders of a cohort, built with one os.scandir pass per folder.
+
+Every NRRD file is resolved to its role exactly: IMG_CT, IMG_MR, or the label_order channel
+whose name appears in the file name as whole '_'/'-' separated tokens (the longest match wins,
+so 'Glnd_Lacrimal_L' is never confused with a shorter name). The index is saved as JSON and reused by load_data,
+load_data_parallel and the preprocessing cache instead of listing the folders again:
+
+    {"version": 1, "data_root": ..., "label_order": [...], "cases": [
+        {"case_folder": ..., "ct": ".../IMG_CT.nrrd", "mr": ".../IMG_MR.nrrd",
+         "labels": [path of channel 0, path of channel 1, ...],   (None for a missing structure)
+         "unmatched": [...], "files": [[name, size, mtime_ns], ...],
+         "geometry": {"ct": {"size": ..., "spacing": ..., "origin": ..., "direction": ...}, "mr": {...}}},
+        ...]}
+"""
+
+import json
+import os
+import re
+
+import SimpleITK as sitk
+
+from mtct.labels import label_order as default_label_order
+
+INDEX_VERSION = 1
+
+_TOKEN_SEPARATORS = re.compile(r'[_\- ]+')
+
+# label_order channel of a label file name, or None. The name without its extensions (everything
+# after the first '.', e.g. '.seg.nrrd') is split into '_'/'-'/' ' separated tokens, and the
+# structure name has to appear as a run of whole tokens anywhere in it: 'Mask_Lens_L.nrrd',
+# 'case_01_OAR_Lens_L.seg.nrrd' and 'case_01_Lens_L_mask.nrrd' are all Lens_L, 'Lens_LR.nrrd' is not.
+def label_channel(file_name, label_order=default_label_order):
+    tokens = _TOKEN_SEPARATORS.split(file_name.split('.', 1)[0])
+    best = None
+    for channel, label in enumerate(label_order):
+        label_tokens = _TOKEN_SEPARATORS.split(label)
+        n = len(label_tokens)
+        if any(tokens[i:i + n] == label_tokens for i in range(len(tokens) - n + 1)):
+            if best is None or len(label) > len(label_order[best]):
+                best = channel
+    return best
+
+# Size, spacing, origin and direction from the image header, without reading the voxels
+def read_geometry(path):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return {
+        "size": list(reader.GetSize()),
+        "spacing": list(reader.GetSpacing()),
+        "origin": list(reader.GetOrigin()),
+        "direction": list(reader.GetDirection()),
+    }
+
+# Index entry of one case folder (see the module docstring). With label_order=None the label
+# files are kept in name order instead of being mapped to channels.
+def index_case(case_folder, label_order=default_label_order, with_geometry=True):
+    ct_files, mr_files, label_files, files = [], [], [], []
+    with os.scandir(case_folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.nrrd') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            files.append([entry.name, stat.st_size, stat.st_mtime_ns])
+            if "IMG_CT" in entry.name:
+                ct_files.append(entry.path)
+            elif "IMG_MR" in entry.name:
+                mr_files.append(entry.path)
+            else:
+                label_files.append(entry.path)
+
+    unmatched = []
+    if label_order:
+        labels = [None] * len(label_order)
+        for path in sorted(label_files):
+            channel = label_channel(os.path.basename(path), label_order)
+            if channel is None or labels[channel] is not None:
+                unmatched.append(path)
+            else:
+                labels[channel] = path
+    else:
+        labels = sorted(label_files)
+
+    entry = {
+        "case_folder": case_folder,
+        "ct": min(ct_files) if ct_files else None,
+        "mr": min(mr_files) if mr_files else None,
+        "labels": labels,
+        "unmatched": unmatched,
+        "files": sorted(files),
+    }
+    if with_geometry:
+        entry["geometry"] = {modality: read_geometry(entry[modality])
+                             for modality in ('ct', 'mr') if entry[modality] is not None}
+    return entry
+
+# Index every case folder directly below data_root (sorted by name) and save it to index_path if given
+def build_case_index(data_root, label_order=default_label_order, index_path=None, with_geometry=True):
+    with os.scandir(data_root) as entries:
+        case_folders = sorted(entry.path for entry in entries if entry.is_dir())
+
+    index = {
+        "version": INDEX_VERSION,
+        "data_root": data_root,
+        "label_order": list(label_order) if label_order else None,
+        "cases": [index_case(folder, label_order, with_geometry=with_geometry) for folder in case_folders],
+    }
+    if index_path is not None:
+        save_case_index(index, index_path)
+    return index
+
+# Bring a loaded index up to date with data_root: case folders that are new or whose NRRD files
+# changed (name, size or mtime) since the index was built are indexed again, folders that are
+# gone are dropped. One os.scandir per folder. Saves the index to index_path if anything changed.
+def refresh_case_index(index, data_root=None, index_path=None, with_geometry=True):
+    data_root = data_root or index['data_root']
+    label_order = index['label_order']
+    entries = {entry['case_folder']: entry for entry in index['cases']}
+    with os.scandir(data_root) as items:
+        case_folders = sorted(item.path for item in items if item.is_dir())
+
+    cases, changed = [], len(case_folders) != len(entries)
+    for folder in case_folders:
+        entry = entries.get(folder)
+        if entry is not None:
+            with os.scandir(folder) as items:
+                files = sorted([item.name, item.stat().st_size, item.stat().st_mtime_ns]
+                               for item in items if item.name.endswith('.nrrd') and item.is_file())
+            if files == entry['files']:
+                cases.append(entry)
+                continue
+        cases.append(index_case(folder, label_order, with_geometry=with_geometry))
+        changed = True
+
+    index = dict(index, data_root=data_root, cases=cases)
+    if changed and index_path is not None:
+        save_case_index(index, index_path)
+    return index
+
+def save_case_index(index, index_path):
+    index_dir = os.path.dirname(index_path)
+    if index_dir:
+        os.makedirs(index_dir, exist_ok=True)
+    with open(index_path + '.tmp', 'w') as file:
+        json.dump(index, file, indent=2)
+    os.replace(index_path + '.tmp', index_path)
+
+def load_case_index(index_path):
+    with open(index_path) as file:
+        index = json.load(file)
+    if index.get('version') != INDEX_VERSION:
+        raise ValueError(f"Unsupported case index version {index.get('version')} in {index_path}")
+    return index
+
+# True if every structure of the entry's label_order has a label file
+def is_complete(entry):
+    return entry['ct'] is not None and entry['mr'] is not None and all(path is not None for path in entry['labels'])
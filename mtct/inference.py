@@ -0,0 +1,151 @@
+"""Sliding-window inference on full-resolution volumes.
+
+The model runs over overlapping ROI windows of a working grid, the windows are blended with
+Gaussian weights, and the predictions are resampled back onto the original CT geometry.
+The working grid is chosen per case:
+
+    reference_size   CT and MR are each squashed to reference_size by resize_image, exactly
+                     like load_data does for training (the default, for whole-volume models)
+    spacing          the CT grid resampled to a fixed working spacing (reference_size=None)
+    native           the CT grid itself (reference_size=None, spacing=None)
+
+The last two suit models trained on patches (mtct.sampling); in both the MR is resampled onto
+the CT grid.
+"""
+
+import os
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+from monai.inferers import sliding_window_inference
+
+from mtct.data import resize_image
+from mtct.index import index_case
+from mtct.labels import label_order as default_label_order
+from mtct.normalization import CT_WINDOW, MR_PERCENTILES, normalize_volume
+
+# Run model over overlapping roi_size windows of inputs (B, C, D, H, W) and blend them.
+# sw_batch_size windows go through the model at once. For the UNets every roi_size dimension
+# must be divisible by the product of the strides (16). Returns the blended logits.
+def sliding_window_predict(model, inputs, roi_size=(128, 128, 128), overlap=0.25, sw_batch_size=4,
+                           mode='gaussian', sigma_scale=0.125):
+    return sliding_window_inference(inputs, roi_size=roi_size, sw_batch_size=sw_batch_size, predictor=model,
+                                    overlap=overlap, mode=mode, sigma_scale=sigma_scale)
+
+# Resample image onto a grid with the given spacing and the same physical extent
+def resample_to_spacing(image, spacing, interpolator=sitk.sitkLinear):
+    original_size = np.array(image.GetSize())
+    original_spacing = np.array(image.GetSpacing())
+    new_size = np.maximum(np.round(original_size * original_spacing / np.array(spacing)), 1).astype(int)
+
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize([int(size) for size in new_size])
+    resampler.SetOutputSpacing(tuple(float(s) for s in spacing))
+    resampler.SetOutputOrigin(image.GetOrigin())
+    resampler.SetOutputDirection(image.GetDirection())
+    resampler.SetInterpolator(interpolator)
+    return resampler.Execute(image)
+
+# Resample image onto the grid of reference
+def resample_to_reference(image, reference, interpolator=sitk.sitkLinear, default_value=0.0):
+    return sitk.Resample(image, reference, sitk.Transform(), interpolator, default_value, image.GetPixelID())
+
+# CT and MR file of a case folder, resolved by index_case like everywhere else in the pipeline
+def _case_images(case_folder):
+    entry = index_case(case_folder, label_order=None, with_geometry=False)
+    if entry['ct'] is None or entry['mr'] is None:
+        raise FileNotFoundError(f"CT or MR file missing in {case_folder}")
+    return entry['ct'], entry['mr']
+
+# Read the CT and MR of a case folder like load_data: each squashed to reference_size on its own grid.
+# Returns the (2, D, H, W) float32 image, the resized CT image (the working grid) and the original
+# CT image, whose geometry the predictions are mapped back to.
+def read_case_resized(case_folder, reference_size=(128, 128, 128)):
+    ct_path, mr_path = _case_images(case_folder)
+    ct_reference = sitk.ReadImage(ct_path)
+    ct_image = resize_image(ct_reference, reference_size)
+    mr_image = resize_image(sitk.ReadImage(mr_path), reference_size)
+
+    image = np.stack([sitk.GetArrayFromImage(ct_image), sitk.GetArrayFromImage(mr_image)]).astype(np.float32)
+    return image, ct_image, ct_reference
+
+# Read the CT and MR of a case folder on the CT grid, optionally resampled to a working spacing.
+# Returns (image, working_grid, ct_reference) like read_case_resized.
+def read_case_native(case_folder, spacing=None):
+    ct_path, mr_path = _case_images(case_folder)
+    ct_reference = sitk.ReadImage(ct_path, sitk.sitkFloat32)
+    mr_image = sitk.ReadImage(mr_path, sitk.sitkFloat32)
+
+    ct_image = ct_reference if spacing is None else resample_to_spacing(ct_reference, spacing)
+    mr_image = resample_to_reference(mr_image, ct_image)
+
+    image = np.stack([sitk.GetArrayFromImage(ct_image), sitk.GetArrayFromImage(mr_image)]).astype(np.float32)
+    return image, ct_image, ct_reference
+
+# Read and normalize the CT/MR of a case folder for predict_probabilities, on the working grid
+# given by reference_size or spacing (see the module docstring; set reference_size=None to use spacing).
+# Returns (image, working_grid, ct_reference) like read_case_resized.
+def prepare_case(case_folder, reference_size=(128, 128, 128), spacing=None, normalization_modes=('minmax', 'minmax'),
+                 ct_window=CT_WINDOW, mr_percentiles=MR_PERCENTILES):
+    if reference_size is not None:
+        if spacing is not None:
+            raise ValueError("Pass either reference_size or spacing, not both")
+        image, working_grid, ct_reference = read_case_resized(case_folder, reference_size)
+    else:
+        image, working_grid, ct_reference = read_case_native(case_folder, spacing=spacing)
+    for channel, mode in zip(image, normalization_modes):
+        normalize_volume(channel, mode, ct_window=ct_window, mr_percentiles=mr_percentiles)
+    return image, working_grid, ct_reference
+
+# Sigmoid probabilities (num_output_channels, D, H, W) of a prepared (2, D, H, W) image, as a numpy array
+def predict_probabilities(model, image, device, roi_size=(128, 128, 128), overlap=0.25, sw_batch_size=4):
+    model.eval()
+    with torch.no_grad():
+        inputs = torch.from_numpy(image).unsqueeze(0).to(device)
+        # Windows run on the device, the blended volume is accumulated on the CPU
+        probabilities = torch.sigmoid(sliding_window_inference(
+            inputs, roi_size=roi_size, sw_batch_size=sw_batch_size, predictor=model, overlap=overlap,
+            mode='gaussian', sw_device=device, device=torch.device('cpu')))[0].numpy()
+    return probabilities
+
+def _same_grid(image, reference):
+    return (image.GetSize() == reference.GetSize() and image.GetSpacing() == reference.GetSpacing()
+            and image.GetOrigin() == reference.GetOrigin() and image.GetDirection() == reference.GetDirection())
+
+# Threshold the probabilities on the working grid into uint8 masks in the original CT geometry.
+# Probabilities on another grid than the CT are resampled (linearly) before thresholding.
+def probabilities_to_masks(probabilities, working_grid, ct_reference, threshold=0.5):
+    resample = not _same_grid(working_grid, ct_reference)
+    masks = []
+    for channel_probabilities in probabilities:
+        probability_image = sitk.GetImageFromArray(channel_probabilities.astype(np.float32))
+        probability_image.CopyInformation(working_grid)
+        if resample:
+            probability_image = resample_to_reference(probability_image, ct_reference)
+        masks.append(sitk.Cast(probability_image > threshold, sitk.sitkUInt8))
+    return masks
+
+# Predict the masks of one case folder in its original CT geometry.
+# The model runs on the working grid of reference_size / spacing (see prepare_case); the
+# probabilities are resampled back to the original CT geometry before thresholding.
+# Returns a list of num_output_channels uint8 sitk images in the original CT geometry.
+def predict_full_resolution(model, case_folder, device, roi_size=(128, 128, 128), overlap=0.25, sw_batch_size=4,
+                            threshold=0.5, reference_size=(128, 128, 128), spacing=None,
+                            normalization_modes=('minmax', 'minmax'), ct_window=CT_WINDOW, mr_percentiles=MR_PERCENTILES):
+    image, working_grid, ct_reference = prepare_case(case_folder, reference_size=reference_size, spacing=spacing,
+                                                     normalization_modes=normalization_modes,
+                                                     ct_window=ct_window, mr_percentiles=mr_percentiles)
+    probabilities = predict_probabilities(model, image, device, roi_size=roi_size, overlap=overlap,
+                                          sw_batch_size=sw_batch_size)
+    return probabilities_to_masks(probabilities, working_grid, ct_reference, threshold=threshold)
+
+# Write the masks of predict_full_resolution as output_dir/<structure>.nrrd, returns the paths
+def write_case_masks(masks, output_dir, label_order=default_label_order):
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for name, mask in zip(label_order, masks):
+        path = os.path.join(output_dir, f"{name}.nrrd")
+        sitk.WriteImage(mask, path, useCompression=True)
+        paths.append(path)
+    return paths
@@ -0,0 +1,10 @@
+"""Structure names, in the channel order of the label volumes and model outputs."""
+
+# label_order of didderent cases
+label_order = [
+    'Arytenoid', 'Brainstem', 'BuccalMucosa', 'A_Carotid_L', 'A_Carotid_R',
+    'Esophagus_S', 'Cochlea_L', 'Cochlea_R', 'Cricopharyngeus', 'Eye_L', 'Eye_R',
+    'Lens_L', 'Lens_R', 'Glnd_Lacrimal_L', 'Glnd_Lacrimal_R', 'Glottis', 'Larynx_SG',
+    'Lips', 'Bone_Mandible', 'OpticChiasm', 'OpticNrv_L', 'OpticNrv_R', 'Cavity_Oral',
+    'Parotid_L', 'Parotid_R', 'Pituitary', 'SpinalCord', 'Glnd_Submand_L', 'Glnd_Submand_R', 'Glnd_Thyroid'
+]
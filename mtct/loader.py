@@ -0,0 +1,77 @@
+"""Dataset/collate pair that keeps batches on the CPU so the DataLoader can use workers and pinned memory.
+
+custom_collate builds the batch with np.array + torch.tensor and moves it to the GPU inside the
+collate function, which rules out num_workers > 0 (no CUDA in worker processes) and pinned,
+asynchronous copies. Here the batch stays a CPU tensor and the training loop moves it with
+move_batch_to_device(..., non_blocking=True).
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+# Wraps a list of {"image", "labels"} cases (or a MemmapCaseDataset) and returns float32 CPU
+# tensors. torch.from_numpy shares the memory of the contiguous float32 array, so a case that
+# already is float32 is not copied again. Bitfield labels (mtct.bitfield) stay int32, they are
+# expanded on the device.
+class CaseTensorDataset(Dataset):
+    def __init__(self, cases):
+        self.cases = cases
+
+    def __len__(self):
+        return len(self.cases)
+
+    # Passed on to datasets that sample per epoch (e.g. PatchDataset)
+    def set_epoch(self, epoch):
+        if hasattr(self.cases, 'set_epoch'):
+            self.cases.set_epoch(epoch)
+
+    def __getitem__(self, idx):
+        data = self.cases[idx]
+        image = np.ascontiguousarray(data['image'], dtype=np.float32)
+        labels = np.asarray(data['labels'])
+        if labels.dtype == np.int32 and labels.ndim == 3:
+            labels = np.ascontiguousarray(labels)
+        else:
+            labels = np.ascontiguousarray(labels, dtype=np.float32)
+        return {"image": torch.from_numpy(image), "labels": torch.from_numpy(labels)}
+
+# Original collate function, builds the batch on the device (so only usable with num_workers=0).
+# device defaults to CUDA when available.
+def custom_collate(batch, device=None):
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    images = torch.tensor(np.array([item["image"] for item in batch]), dtype=torch.float32).to(device)
+    labels = torch.tensor(np.array([item["labels"] for item in batch]), dtype=torch.float32).to(device)
+
+    return {"images": images, "labels": labels}
+
+# Stacks the case tensors into one batch tensor, same keys as custom_collate but left on the CPU.
+def cpu_collate(batch):
+    images = torch.stack([item["image"] for item in batch])
+    labels = torch.stack([item["labels"] for item in batch])
+    return {"images": images, "labels": labels}
+
+# DataLoader over a CaseTensorDataset. pin_memory defaults to True when CUDA is available;
+# persistent_workers and prefetch_factor only apply with num_workers > 0. A sampler (e.g. a
+# DistributedSampler) replaces shuffle.
+def make_data_loader(dataset, batch_size=2, shuffle=False, num_workers=0, pin_memory=None,
+                     persistent_workers=True, prefetch_factor=2, drop_last=True, collate_fn=cpu_collate, sampler=None):
+    if not isinstance(dataset, CaseTensorDataset):
+        dataset = CaseTensorDataset(dataset)
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = {"persistent_workers": persistent_workers, "prefetch_factor": prefetch_factor}
+
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle and sampler is None, sampler=sampler,
+                      num_workers=num_workers, pin_memory=pin_memory, collate_fn=collate_fn, drop_last=drop_last,
+                      **worker_kwargs)
+
+# Host-to-device copy of a batch. With pinned memory the copies are asynchronous and overlap
+# with the compute already queued on the device.
+def move_batch_to_device(batch, device, non_blocking=True):
+    return {key: value.to(device, non_blocking=non_blocking) if torch.is_tensor(value) else value
+            for key, value in batch.items()}
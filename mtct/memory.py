@@ -0,0 +1,246 @@
+"""Memory-saving training mode: activation checkpointing and a channel-chunked Dice loss.
+
+A training step keeps every encoder/decoder activation of the UNet for the backward pass, plus
+the sigmoid and its products for the 30-channel Dice loss at full resolution. Two knobs trade
+compute for memory:
+
+- checkpoint_levels: the down and up blocks of the N highest-resolution UNet levels (the ones
+  with the largest activations) only keep their input and recompute the rest in the backward
+  pass ('all' also checkpoints the bottom block). State dict keys don't change.
+- dice_chunk_size: ChunkedDiceLoss computes the Dice loss dice_chunk_size channels at a time
+  and recomputes each chunk in the backward pass, so only one chunk of intermediates exists at
+  a time instead of several (B, 30, D, H, W) tensors.
+
+compare_memory_settings measures the tensors kept for the backward pass, the peak device memory
+(CUDA only; the Dice chunks mostly lower this transient peak, not the kept tensors) and the step
+time of every setting on random inputs, to pick one before a run:
+
+    python -m mtct.memory --model scratch --batch-sizes 2 4 --levels 0 1 2 all --dice-chunk-sizes 0 6
+
+Recomputed BatchNorm blocks run in train mode twice; their running statistics are restored
+after the recomputation so they are updated once per step, like without checkpointing.
+"""
+
+import argparse
+import contextlib
+import functools
+import json
+import time
+
+import torch
+from monai.networks.layers.simplelayers import SkipConnection
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+# Running statistics of the BatchNorm layers of module are reset to their values on entry
+@contextlib.contextmanager
+def _frozen_batch_norm_stats(module):
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in norms]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for m, (mean, var, count) in zip(norms, saved):
+                m.running_mean.copy_(mean)
+                m.running_var.copy_(var)
+                m.num_batches_tracked.copy_(count)
+
+def _checkpointed_forward(module, *inputs):
+    forward = type(module).forward.__get__(module)
+    if not (module.training and torch.is_grad_enabled()):
+        return forward(*inputs)
+
+    recomputing = False
+
+    def run(*args):
+        nonlocal recomputing
+        if recomputing:
+            with _frozen_batch_norm_stats(module):
+                return forward(*args)
+        recomputing = True
+        return forward(*args)
+
+    return checkpoint(run, *inputs, use_reentrant=False)
+
+# The monai UNet inside one of the mtct.models variants
+def _unet_of(model):
+    for name in ('unet', 'model'):
+        unet = getattr(model, name, None)
+        if unet is not None and hasattr(unet, 'model'):
+            return unet
+    raise ValueError(f"No monai UNet found in {type(model).__name__}")
+
+# (down, up) blocks of every UNet level, highest resolution first, and the bottom block
+def unet_levels(model):
+    block = _unet_of(model).model
+    levels = []
+    while isinstance(block, nn.Sequential) and len(block) == 3 and isinstance(block[1], SkipConnection):
+        levels.append((block[0], block[2]))
+        block = block[1].submodule
+    return levels, block
+
+# Checkpoint the down and up blocks of the top num_levels UNet levels of model (an int, or
+# 'all' for every level and the bottom block). Returns the checkpointed blocks.
+def enable_activation_checkpointing(model, num_levels):
+    disable_activation_checkpointing(model)
+    levels, bottom = unet_levels(model)
+    if num_levels == 'all':
+        blocks = [block for level in levels for block in level] + [bottom]
+    else:
+        blocks = [block for level in levels[:int(num_levels)] for block in level]
+    for block in blocks:
+        # An instance attribute, so the module tree and the state dict keys stay the same
+        block.forward = functools.partial(_checkpointed_forward, block)
+        block._activation_checkpointed = True
+    return blocks
+
+def disable_activation_checkpointing(model):
+    for module in model.modules():
+        if getattr(module, '_activation_checkpointed', False):
+            del module.forward
+            del module._activation_checkpointed
+
+# DiceLoss(smooth_nr, smooth_dr, squared_pred=True, sigmoid=True) over chunk_size channels at a
+# time. Each chunk is recomputed in the backward pass when the outputs require grad.
+class ChunkedDiceLoss(nn.Module):
+    def __init__(self, chunk_size=6, smooth_nr=0.0, smooth_dr=1e-5):
+        super(ChunkedDiceLoss, self).__init__()
+        self.chunk_size = chunk_size
+        self.smooth_nr = smooth_nr
+        self.smooth_dr = smooth_dr
+
+    def _chunk_loss(self, outputs, targets):
+        probabilities = torch.sigmoid(outputs.float())
+        targets = targets.float()
+        spatial_dims = tuple(range(2, outputs.dim()))
+        intersection = torch.sum(probabilities * targets, dim=spatial_dims)
+        denominator = torch.sum(probabilities ** 2, dim=spatial_dims) + torch.sum(targets ** 2, dim=spatial_dims)
+        return 1.0 - (2.0 * intersection + self.smooth_nr) / (denominator + self.smooth_dr)
+
+    def forward(self, outputs, targets):
+        losses = []
+        for start in range(0, outputs.shape[1], self.chunk_size):
+            chunk = (outputs[:, start:start + self.chunk_size], targets[:, start:start + self.chunk_size])
+            if outputs.requires_grad:
+                losses.append(checkpoint(self._chunk_loss, *chunk, use_reentrant=False))
+            else:
+                losses.append(self._chunk_loss(*chunk))
+        return torch.cat(losses, dim=1).mean()
+
+# Switch model (one of the mtct.models variants) to the memory-saving mode. checkpoint_levels=0
+# and dice_chunk_size=None leave the model as it is. Returns model.
+def enable_memory_saving(model, checkpoint_levels=0, dice_chunk_size=None):
+    if checkpoint_levels:
+        enable_activation_checkpointing(model, checkpoint_levels)
+    else:
+        disable_activation_checkpointing(model)
+    if dice_chunk_size:
+        loss = model.loss_function
+        model.loss_function = ChunkedDiceLoss(dice_chunk_size, smooth_nr=getattr(loss, 'smooth_nr', 0.0),
+                                              smooth_dr=getattr(loss, 'smooth_dr', 1e-5))
+    return model
+
+# Bytes of the tensors saved for the backward pass by fn (parameters excluded, shared storage
+# counted once), and fn's result
+def saved_activation_bytes(fn, parameters=()):
+    parameter_ptrs = {p.untyped_storage().data_ptr() for p in parameters}
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in parameter_ptrs:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        result = fn()
+    return sum(storages.values()), result
+
+# Forward + loss + backward of model on (inputs, labels) for every setting, a dict with
+# checkpoint_levels and dice_chunk_size. Returns one result per setting with the saved
+# activation bytes, the peak device memory (CUDA only), the mean step time and samples/sec.
+# Afterwards the model has its original loss and weights, without activation checkpointing.
+def compare_memory_settings(model, inputs, labels, settings, repeat=3):
+    device = inputs.device
+    original_loss = model.loss_function
+    parameters = list(model.parameters())
+    state = {key: value.clone() for key, value in model.state_dict().items()}
+    model.train()
+    results = []
+
+    def step():
+        model.zero_grad(set_to_none=True)
+        activation_bytes, loss = saved_activation_bytes(lambda: model.loss_function(model(inputs), labels), parameters)
+        loss.backward()
+        return activation_bytes
+
+    try:
+        for setting in settings:
+            model.loss_function = original_loss
+            enable_memory_saving(model, **setting)
+            step()  # warmup
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+                torch.cuda.reset_peak_memory_stats(device)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                activation_bytes = step()
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            step_time = (time.perf_counter() - start) / repeat
+            results.append(dict(setting, batch_size=inputs.shape[0], activation_bytes=activation_bytes,
+                                peak_device_memory=torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else None,
+                                step_time=step_time, samples_per_sec=inputs.shape[0] / step_time))
+    finally:
+        model.loss_function = original_loss
+        disable_activation_checkpointing(model)
+        model.zero_grad(set_to_none=True)
+        model.load_state_dict(state)
+    return results
+
+def format_memory_table(results):
+    lines = [f"{'batch':>5} {'levels':>6} {'chunk':>5} {'activations':>12} {'peak device':>12} {'step':>8} {'samples/s':>9}"]
+    for r in results:
+        peak = f"{r['peak_device_memory'] / 2**30:.2f} GiB" if r['peak_device_memory'] is not None else '-'
+        lines.append(f"{r['batch_size']:>5} {str(r['checkpoint_levels']):>6} {str(r['dice_chunk_size'] or '-'):>5} "
+                     f"{r['activation_bytes'] / 2**30:>8.2f} GiB {peak:>12} {r['step_time']:>7.2f}s "
+                     f"{r['samples_per_sec']:>9.2f}")
+    return "\n".join(lines)
+
+def main(argv=None):
+    from mtct.models import MODEL_NAMES, build_model
+
+    parser = argparse.ArgumentParser(description="Compare the memory/throughput of the memory-saving settings.")
+    parser.add_argument('--model', choices=MODEL_NAMES, default='scratch')
+    parser.add_argument('--num-classes', type=int, default=30)
+    parser.add_argument('--size', type=int, default=128, help="input edge length")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[2])
+    parser.add_argument('--levels', nargs='+', default=['0', '1', '2', 'all'],
+                        help="checkpoint_levels to compare (numbers or 'all')")
+    parser.add_argument('--dice-chunk-sizes', type=int, nargs='+', default=[0, 6], help="0 = MONAI DiceLoss")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--output', help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    torch.manual_seed(0)
+    model = build_model(args.model, num_output_channels=args.num_classes, load_pretrained=False, device=device)
+    settings = [{"checkpoint_levels": level if level == 'all' else int(level), "dice_chunk_size": chunk or None}
+                for level in args.levels for chunk in args.dice_chunk_sizes]
+
+    results = []
+    for batch_size in args.batch_sizes:
+        inputs = torch.rand((batch_size, 2) + (args.size,) * 3, device=device)
+        labels = (torch.rand((batch_size, args.num_classes) + (args.size,) * 3, device=device) > 0.9).float()
+        results += compare_memory_settings(model, inputs, labels, settings, repeat=args.repeat)
+        del inputs, labels
+    print(format_memory_table(results))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Per-channel segmentation metrics for all output channels in one batched reduction.
+
+The metrics are accumulated as tensors on the evaluation device and only copied to the host
+once, in compute(), instead of two .item() syncs per channel and batch.
+"""
+
+import torch
+
+# Accumulates per-channel Dice loss, Dice coefficient and optionally IoU and Hausdorff95
+# (Hausdorff95 goes through MONAI's distance transform and does sync per batch).
+# The Dice loss matches DiceLoss(smooth_nr=0, smooth_dr=smooth_dr, squared_pred=True, sigmoid=True)
+# evaluated per sample and channel; Dice, IoU and Hausdorff95 use the masks thresholded at
+# threshold, with the overlap of each channel summed over the whole batch like dice_coefficient.
+class SegmentationMetrics:
+    def __init__(self, num_channels=30, threshold=0.5, include_iou=True, include_hd95=False, smooth_dr=1e-5):
+        self.num_channels = num_channels
+        self.threshold = threshold
+        self.include_iou = include_iou
+        self.include_hd95 = include_hd95
+        self.smooth_dr = smooth_dr
+        self.reset()
+
+    def reset(self):
+        self.num_batches = 0
+        self._sums = {}
+
+    def _add(self, name, value):
+        value = value.detach()
+        if name in self._sums:
+            self._sums[name] += value
+        else:
+            self._sums[name] = value.clone()
+
+    # outputs are logits (B, C, D, H, W), targets the (B, C, D, H, W) masks.
+    # Returns the thresholded predictions as a bool mask so callers don't have to compute them again
+    # (no float copy of the whole batch; extract_mid_slices converts only the slices it keeps).
+    def update(self, outputs, targets):
+        if outputs.shape[1] != self.num_channels:
+            raise ValueError(f"Expected {self.num_channels} output channels, got {outputs.shape[1]}")
+        outputs = outputs.float()
+        targets = targets.float()
+        spatial_dims = tuple(range(2, outputs.dim()))
+
+        probabilities = torch.sigmoid(outputs)
+        intersection = torch.sum(probabilities * targets, dim=spatial_dims)
+        denominator = torch.sum(probabilities ** 2, dim=spatial_dims) + torch.sum(targets ** 2, dim=spatial_dims)
+        dice_loss = 1.0 - 2.0 * intersection / (denominator + self.smooth_dr)
+        self._add('dice_loss', dice_loss.mean(dim=0))
+
+        binary_outputs = probabilities > self.threshold
+        binary_targets = targets > self.threshold
+        batch_dims = (0,) + spatial_dims
+        overlap = torch.sum(binary_outputs & binary_targets, dim=batch_dims).float()
+        union = torch.sum(binary_outputs, dim=batch_dims).float() + torch.sum(binary_targets, dim=batch_dims).float()
+        self._add('dice', 2.0 * overlap / (union + 1e-8))
+        if self.include_iou:
+            self._add('iou', overlap / (union - overlap + 1e-8))
+
+        if self.include_hd95:
+            from monai.metrics import compute_hausdorff_distance
+
+            # NaN/inf for channels where prediction or target is empty; those are left out of the mean
+            hd95 = compute_hausdorff_distance(binary_outputs, binary_targets, include_background=True,
+                                              percentile=95).to(outputs.device)
+            valid = torch.isfinite(hd95)
+            self._add('hd95', torch.where(valid, hd95, torch.zeros_like(hd95)).sum(dim=0))
+            self._add('hd95_count', valid.sum(dim=0).float())
+
+        self.num_batches += 1
+        return binary_outputs
+
+    # Mean per-channel metrics over all batches, as lists of floats (one host sync)
+    def compute(self):
+        if self.num_batches == 0:
+            raise RuntimeError("No batches were added to the metrics")
+        names = list(self._sums)
+        values = dict(zip(names, torch.stack([self._sums[name] for name in names]).cpu()))
+
+        results = {}
+        for name, value in values.items():
+            if name == 'hd95_count':
+                continue
+            if name == 'hd95':
+                count = values['hd95_count']
+                value = torch.where(count > 0, value / count.clamp(min=1), torch.full_like(value, float('nan')))
+            else:
+                value = value / self.num_batches
+            results[name] = value.tolist()
+        return results
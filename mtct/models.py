@@ -0,0 +1,174 @@
+"""Segmentation models: the UNet trained from scratch and the two fine-tuned spleen UNets.
+
+load_pretrained=False builds the fine-tuning wrappers with random UNet weights, without
+downloading the spleen_ct_segmentation bundle (for benchmarks and tests of the plumbing).
+"""
+
+import monai
+import torch
+from monai.losses import DiceLoss
+from torch import nn
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+#Model with last layer frozen
+
+def load_model_last_layer(num_output_channels, load_pretrained=True, device=device):
+    # Load the pre-trained model
+    pretrained_model = monai.networks.nets.UNet(
+        spatial_dims=3,
+        in_channels=1,
+        out_channels=2,  # Adjust this to the number of classes
+        channels=(16, 32, 64, 128, 256),
+        strides=(2, 2, 2, 2),
+        num_res_units=2,
+        norm=monai.networks.layers.Norm.BATCH,
+    )
+    if load_pretrained:
+        pretrained_model.load_state_dict(monai.bundle.load(name="spleen_ct_segmentation", bundle_dir="./"))
+
+    class UNetWithLastLayerFineTuning(nn.Module):
+        def __init__(self, pretrained_model, num_output_channels):
+            super(UNetWithLastLayerFineTuning, self).__init__()
+
+            # Create a UNet model with one input channel
+            self.model = pretrained_model
+
+            self.unfreeze_last_layer()
+
+            self.single_channel_conv = torch.nn.Conv3d(2, 1, kernel_size=1).to(device)
+
+            # Final convolution layer with the correct number of output channels
+            self.final_conv = torch.nn.Conv3d(2, num_output_channels, kernel_size=1).to(device)
+            self.loss_function = DiceLoss(smooth_nr=0, smooth_dr=1e-5, squared_pred=True, to_onehot_y=False, sigmoid=True)
+
+        def unfreeze_last_layer(self):
+            # Freeze all layers except the last layer
+            for param in self.model.parameters():
+                param.requires_grad = False
+            for layer in reversed(list(self.model.children())):
+                if isinstance(layer, nn.Conv3d):
+                    for param in layer.parameters():
+                        param.requires_grad = True
+                    break
+
+        # Input fusion and the UNet, i.e. everything before final_conv
+        def backbone_features(self, inputs):
+            return self.model(self.single_channel_conv(inputs))
+
+        def tail(self, features):
+            return self.final_conv(features)
+
+        def forward(self, inputs):
+            output = self.backbone_features(inputs)
+
+            # Pass through the final convolution layer
+            output_final = self.tail(output)
+
+            return output_final
+
+    # Create an instance of the UNet model with fine-tuning on the last layer
+    model = UNetWithLastLayerFineTuning(pretrained_model, num_output_channels).to(device)
+
+    return model
+
+#Model with last two layer frozen
+def load_model_last_two_layers(num_output_channels, load_pretrained=True, device=device):
+
+
+    # Load the pre-trained model
+    pretrained_model = monai.networks.nets.UNet(
+        spatial_dims=3,
+        in_channels=1,
+        out_channels=2,  # Adjust this to the number of classes
+        channels=(16, 32, 64, 128, 256),
+        strides=(2, 2, 2, 2),
+        num_res_units=2,
+        norm=monai.networks.layers.Norm.BATCH,
+    )
+    if load_pretrained:
+        pretrained_model.load_state_dict(monai.bundle.load(name="spleen_ct_segmentation", bundle_dir="./"))
+
+    class UNetWithTwoChannels(nn.Module):
+        def __init__(self, pretrained_model, num_output_channels):
+            super(UNetWithTwoChannels, self).__init__()
+
+            # Create a UNet model with one input channel
+            self.model = pretrained_model
+
+            # Add a new layer with two input channels to combine with the two-channel input
+            self.single_channel_conv = torch.nn.Conv3d(2, 1, kernel_size=1).to(device)
+
+            self.unfreeze_last_two_layers()
+
+            # Final convolution layer with the correct number of output channels
+            self.final_conv = torch.nn.Conv3d(1, num_output_channels, kernel_size=1).to(device)
+            self.loss_function = DiceLoss(smooth_nr=0, smooth_dr=1e-5, squared_pred=True, to_onehot_y=False, sigmoid=True)
+
+        def unfreeze_last_two_layers(self):
+
+            total_layers = len(list(self.model.children()))
+
+            # Freeze all layers except the last two
+            for idx, layer in enumerate(self.model.children()):
+                if idx < total_layers - 2:
+                    for param in layer.parameters():
+                        param.requires_grad = False
+
+        # Input fusion, the UNet and the shared fusion conv on its output, i.e. everything before final_conv
+        def backbone_features(self, inputs):
+            # Combine CT and MR inputs (assuming they are channels)
+            output = self.model(self.single_channel_conv(inputs))
+            return self.single_channel_conv(output)
+
+        def tail(self, features):
+            return self.final_conv(features)
+
+        def forward(self, inputs):
+            output_final = self.tail(self.backbone_features(inputs))
+
+            return output_final
+
+
+    model = UNetWithTwoChannels(pretrained_model, num_output_channels).to(device)
+
+    return model
+
+
+
+#Model from scratch
+
+class YourModel(torch.nn.Module):
+    def __init__(self, num_classes):
+        super(YourModel, self).__init__()
+
+        self.unet = monai.networks.nets.UNet(
+            spatial_dims=3,
+            in_channels=2,  # Two input channels (2 images)
+            out_channels=num_classes,
+            channels=(16, 32, 64, 128),
+            strides=(2, 2, 2, 2),
+            num_res_units=2
+        )
+
+        self.loss_function = DiceLoss(smooth_nr=0, smooth_dr=1e-5, squared_pred=True, to_onehot_y=False, sigmoid=True)
+
+    def forward(self, x):
+        return self.unet(x)
+
+# Model variants by name, with the learning rates they were trained with
+MODEL_NAMES = ('scratch', 'last_layer', 'last_two_layers')
+MODEL_LEARNING_RATES = {'scratch': 5e-3, 'last_layer': 5e-2, 'last_two_layers': 5e-3}
+
+# Build one of the MODEL_NAMES variants on device. Pass load_pretrained=False when the weights
+# come from a checkpoint anyway, to skip the spleen bundle download.
+def build_model(name, num_output_channels=30, load_pretrained=True, device=device):
+    if name == 'scratch':
+        model = YourModel(num_classes=num_output_channels)
+    elif name == 'last_layer':
+        model = load_model_last_layer(num_output_channels, load_pretrained=load_pretrained, device=device)
+    elif name == 'last_two_layers':
+        model = load_model_last_two_layers(num_output_channels, load_pretrained=load_pretrained, device=device)
+    else:
+        raise ValueError(f"Unknown model '{name}', expected one of {MODEL_NAMES}")
+    return model.to(device)
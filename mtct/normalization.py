@@ -0,0 +1,120 @@
+"""Vectorized intensity normalization of the resized cases, replacing the MinMaxScaler in scale_data."""
+
+import numpy as np
+
+NORMALIZATION_MODES = ('minmax', 'ct_window', 'mr_percentile')
+
+# Default HU window for 'ct_window' and percentiles for 'mr_percentile'
+CT_WINDOW = (-1000.0, 1000.0)
+MR_PERCENTILES = (0.5, 99.5)
+
+def _rescale_(volume, low, high):
+    volume -= low
+    if high > low:
+        volume *= 1.0 / (high - low)
+    return volume
+
+# Scale one float32 volume to [0, 1] in place.
+#   minmax         volume min/max, same result as MinMaxScaler
+#   ct_window      clip to the HU window, then rescale it
+#   mr_percentile  clip to the given intensity percentiles, then rescale them
+def normalize_volume(volume, mode='minmax', ct_window=CT_WINDOW, mr_percentiles=MR_PERCENTILES):
+    if mode == 'minmax':
+        low, high = volume.min(), volume.max()
+    elif mode == 'ct_window':
+        low, high = ct_window
+        np.clip(volume, low, high, out=volume)
+    elif mode == 'mr_percentile':
+        low, high = np.percentile(volume, mr_percentiles)
+        np.clip(volume, low, high, out=volume)
+    else:
+        raise ValueError(f"Unknown normalization mode '{mode}', expected one of {NORMALIZATION_MODES}")
+    return _rescale_(volume, float(low), float(high))
+
+# Normalize the stacked (2, D, H, W) CT/MR image of one case, one mode per modality.
+# The image is scaled in place when it already is a writable float32 array, otherwise it is
+# converted once. Label masks are only checked and stored as uint8, never scaled.
+def normalize_case(data, modes=('minmax', 'minmax'), reference_size=(128, 128, 128),
+                   ct_window=CT_WINDOW, mr_percentiles=MR_PERCENTILES):
+    image = data['image']
+    if not (isinstance(image, np.ndarray) and image.dtype == np.float32 and image.flags.writeable):
+        image = np.array(image, dtype=np.float32)
+    labels = np.asarray(data['labels'])
+
+    expected_shape = tuple(reference_size)[::-1]
+    if image.shape[1:] != expected_shape or labels.shape[1:] != expected_shape:
+        raise ValueError(f"Expected volumes of shape {expected_shape}, got image {image.shape[1:]} "
+                         f"and labels {labels.shape[1:]}")
+    if len(modes) != image.shape[0]:
+        raise ValueError(f"Got {len(modes)} normalization modes for {image.shape[0]} image channels")
+
+    for channel, mode in zip(image, modes):
+        normalize_volume(channel, mode, ct_window=ct_window, mr_percentiles=mr_percentiles)
+
+    if labels.dtype != np.uint8:
+        binary = labels > 0.5
+        if np.any(binary != labels):
+            print("Warning: Labels are not binary (contain values other than 0 and 1), thresholding at 0.5.")
+        labels = binary.astype(np.uint8)
+    elif labels.max(initial=0) > 1:
+        print("Warning: Labels are not binary (contain values other than 0 and 1), thresholding at 0.5.")
+        labels = (labels > 0).astype(np.uint8)
+
+    return {"image": image, "labels": labels}
+
+# Vectorized replacement for scale_data: normalizes every case of loaded_data_resized.
+def normalize_data(loaded_data_resized, modes=('minmax', 'minmax'), reference_size=(128, 128, 128),
+                   ct_window=CT_WINDOW, mr_percentiles=MR_PERCENTILES, verbose=True):
+    loaded_data_scaled = []
+
+    for i, data in enumerate(loaded_data_resized):
+        if data is None:
+            continue
+        data_scaled = normalize_case(data, modes=modes, reference_size=reference_size,
+                                     ct_window=ct_window, mr_percentiles=mr_percentiles)
+        loaded_data_scaled.append(data_scaled)
+
+        if verbose:
+            image = data_scaled['image']
+            print(f"Example {i + 1}: image {image.shape} in [{image.min():.3f}, {image.max():.3f}], "
+                  f"{data_scaled['labels'].shape[0]} labels")
+
+    return loaded_data_scaled
+
+# Original MinMaxScaler based scaling, kept as the reference for normalize_data and the benchmarks.
+# Only works on 128^3 volumes.
+def scale_data(loaded_data_resized):
+    import SimpleITK as sitk
+    from sklearn.preprocessing import MinMaxScaler
+
+    loaded_data_scaled = []  # Define loaded_data_scaled list
+
+    for i, data in enumerate(loaded_data_resized):
+        if data is not None:
+            print(f"Example {i + 1}:")
+            scaler = MinMaxScaler()
+            scaled_images = [scaler.fit_transform(image.reshape(-1, 1)).reshape(128, 128, 128) if isinstance(image, np.ndarray) else
+                             scaler.fit_transform(sitk.GetArrayFromImage(image).reshape(-1, 1)).reshape(128, 128, 128) for image in data['image']]
+
+            scaled_labels = [scaler.fit_transform(label.reshape(-1, 1)).reshape(128, 128, 128) if isinstance(label, np.ndarray) else
+                             scaler.fit_transform(sitk.GetArrayFromImage(label).reshape(-1, 1)).reshape(128, 128, 128) for label in data['labels']]
+            data_scaled = {"image": scaled_images, "labels": scaled_labels}
+            loaded_data_scaled.append(data_scaled)
+
+            min_pixel_value = scaled_images[0].min()
+            max_pixel_value = scaled_images[0].max()
+            print(f"Min Scaled Pixel Value: {min_pixel_value}, Max Scaled Pixel Value: {max_pixel_value}")
+            if min_pixel_value < 0 or max_pixel_value > 1:
+                print("Warning: Scaled Image pixel values are not in the range [0, 1].")
+
+            print(f"Scaled Image Size: {scaled_images[0].shape}")
+            print(f"Number of Scaled Labels: {len(scaled_labels)}")
+            unique_label_values = set(scaled_labels[0].flatten())
+            print(f"Unique Scaled Label Values: {unique_label_values}")
+            if not all(value in {0, 1} for value in unique_label_values):
+                print("Warning: Scaled Labels are not binary (contain values other than 0 and 1).")
+
+            print(f"Scaled Label Size: {scaled_labels[0].shape}")
+            print("=" * 30)
+
+    return loaded_data_scaled
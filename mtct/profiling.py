@@ -0,0 +1,165 @@
+"""Opt-in instrumentation of the training and test loops.
+
+A StepProfiler passed to train_model_with_early_stopping or test_model records, for every step,
+the time spent waiting for the DataLoader and in the host-to-device copy, augmentation, forward
+pass (with the loss and, for test_model, the metrics), backward pass and optimizer step, the
+batch size, and the peak host/device memory.
+summary() aggregates the steps (mean, median, p95 and share per phase, samples/sec), export_json
+writes steps and summary, write_tensorboard writes them as TensorBoard scalars (needs the
+tensorboard package). With trace_dir set, torch.profiler skips trace_wait steps, warms up for
+trace_warmup steps and records the next trace_active steps into a Chrome/TensorBoard trace file:
+
+    profiler = StepProfiler(device, trace_dir='traces')
+    train_model_with_early_stopping(model, train_loader, ..., profiler=profiler)
+    profiler.export_json('train_profile.json')
+
+On CUDA the phases are synchronized (sync=True) so every phase is charged with its own kernels;
+this removes the overlap between steps the loops otherwise rely on, so throughput measured with
+profiling is a lower bound.
+"""
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+PHASES = ('data', 'transfer', 'augment', 'forward', 'backward', 'optimizer')
+
+# Phase context of profiler, or a no-op when profiling is off
+def phase_timer(profiler):
+    if profiler is None:
+        return lambda name: contextlib.nullcontext()
+    return profiler.phase
+
+# Peak resident set size of this process in bytes
+def peak_host_memory():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class StepProfiler:
+    def __init__(self, device, sync=True, trace_dir=None, trace_wait=1, trace_warmup=1, trace_active=3):
+        self.device = torch.device(device)
+        self.sync = sync and self.device.type == 'cuda'
+        self.trace_dir = trace_dir
+        self.trace_schedule = (trace_wait, trace_warmup, trace_active)
+        self.steps = []
+        self._current = None
+        self._last_end = None
+        self._torch_profiler = None
+        self._peak_reset = False
+
+    def _synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+
+    # Call right before iterating over the loader, the wait for the first batch counts as 'data'.
+    # Called again every epoch; the device memory peak is only reset on the first call, so it
+    # covers the whole run.
+    def start(self):
+        if self.device.type == 'cuda' and not self._peak_reset:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._peak_reset = True
+        if self.trace_dir is not None and self._torch_profiler is None:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            wait, warmup, active = self.trace_schedule
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torch_profiler = torch.profiler.profile(
+                activities=activities, schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir), profile_memory=True,
+                record_shapes=True)
+            self._torch_profiler.start()
+        self._synchronize()
+        self._last_end = time.perf_counter()
+
+    # Call at the top of the loop body, right after the batch came out of the loader
+    def start_step(self):
+        if self._last_end is None:
+            self.start()
+        now = time.perf_counter()
+        self._current = dict.fromkeys(PHASES, 0.0)
+        self._current['data'] = now - self._last_end
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+            self._synchronize()
+        self._current[name] += time.perf_counter() - start
+
+    def end_step(self, batch_size):
+        self._synchronize()
+        self._last_end = time.perf_counter()
+        step = self._current
+        step['batch_size'] = int(batch_size)
+        step['total'] = sum(step[name] for name in PHASES)
+        self.steps.append(step)
+        self._current = None
+        if self._torch_profiler is not None:
+            self._torch_profiler.step()
+
+    # Stop the torch.profiler trace (if still running), call after the loop
+    def stop(self):
+        if self._torch_profiler is not None:
+            self._torch_profiler.stop()
+            self._torch_profiler = None
+        self._last_end = None
+
+    def summary(self):
+        if not self.steps:
+            return {"steps": 0}
+        totals = np.array([step['total'] for step in self.steps])
+        samples = sum(step['batch_size'] for step in self.steps)
+        phases = {}
+        for name in PHASES:
+            times = np.array([step[name] for step in self.steps])
+            phases[name] = {
+                "mean": float(times.mean()),
+                "p50": float(np.percentile(times, 50)),
+                "p95": float(np.percentile(times, 95)),
+                "total": float(times.sum()),
+                "share": float(times.sum() / totals.sum()) if totals.sum() > 0 else 0.0,
+            }
+        summary = {
+            "steps": len(self.steps),
+            "samples": samples,
+            "samples_per_sec": samples / totals.sum() if totals.sum() > 0 else 0.0,
+            "step_time_mean": float(totals.mean()),
+            "step_time_p95": float(np.percentile(totals, 95)),
+            "phases": phases,
+            "peak_host_memory": peak_host_memory(),
+            "peak_device_memory": torch.cuda.max_memory_allocated(self.device) if self.device.type == 'cuda' else None,
+        }
+        return summary
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary['steps']:
+            return
+        shares = ", ".join(f"{name} {values['mean'] * 1000:.1f}ms ({values['share']:.0%})"
+                           for name, values in summary['phases'].items())
+        print(f"{summary['steps']} steps, {summary['samples_per_sec']:.2f} samples/s: {shares}; "
+              f"peak host memory {summary['peak_host_memory'] / 2**30:.2f} GiB")
+
+    def export_json(self, path):
+        with open(path, 'w') as file:
+            json.dump({"summary": self.summary(), "steps": self.steps}, file, indent=2)
+
+    def write_tensorboard(self, log_dir, tag='profile'):
+        from torch.utils.tensorboard import SummaryWriter
+
+        writer = SummaryWriter(log_dir)
+        for index, step in enumerate(self.steps):
+            for name in PHASES + ('total',):
+                writer.add_scalar(f"{tag}/{name}_ms", step[name] * 1000, index)
+            if step['total'] > 0:
+                writer.add_scalar(f"{tag}/samples_per_sec", step['batch_size'] / step['total'], index)
+        writer.close()
@@ -0,0 +1,171 @@
+"""Patch (sub-volume) sampling for training on random crops instead of full volumes."""
+
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from mtct.bitfield import label_channel_mask
+from mtct.labels import label_order as default_label_order
+
+# Structures that only cover a few hundred voxels and are rarely hit by a uniformly random crop
+SMALL_STRUCTURES = ('Cochlea_L', 'Cochlea_R', 'Lens_L', 'Lens_R', 'OpticChiasm', 'Pituitary')
+
+# Random crops of patch_size (D, H, W) from the cases of a dataset (a list of cases or a
+# MemmapCaseDataset, which then only reads the cropped region from disk).
+# With probability foreground_prob a crop is centred on a voxel of one of the oversampled
+# structures, otherwise anywhere in the volume. The candidate centres of each case are computed
+# once (at most max_centres per structure) and kept in memory, and in cache_dir if given. The
+# cache files are keyed by the case's labels (the file and its size/mtime for a MemmapCaseDataset,
+# a hash of the label array otherwise), the oversampled channels and max_centres, so a rewritten
+# store or another dataset sharing cache_dir never gets the centres of a different case.
+# Every case yields patches_per_case crops per epoch. With seed set the crops are reproducible;
+# set_epoch (called by train_model_with_early_stopping) makes them differ between epochs, also
+# when the loader starts new worker processes every epoch or a run is resumed.
+class PatchDataset(Dataset):
+    def __init__(self, cases, patch_size=(96, 96, 96), patches_per_case=4, foreground_prob=0.7,
+                 oversample_labels=SMALL_STRUCTURES, label_order=default_label_order, max_centres=512,
+                 cache_dir=None, seed=None):
+        self.cases = cases
+        self.patch_size = tuple(patch_size)
+        self.patches_per_case = patches_per_case
+        self.foreground_prob = foreground_prob
+        self.oversample_channels = [label_order.index(name) for name in oversample_labels]
+        self.max_centres = max_centres
+        self.cache_dir = cache_dir
+        self.seed = seed
+        self.epoch = 0
+        self._centres = {}
+        self._rng_state = None
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self.cases) * self.patches_per_case
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    # One generator per process and epoch: DataLoader workers get different torch seeds (or worker
+    # ids with seed set), so their crops differ. Persistent workers keep the generator of the epoch
+    # they were started in and draw on from it.
+    def _rng(self):
+        state = (os.getpid(), self.epoch)
+        if self._rng_state is None or self._rng_state[0] != state:
+            seed = torch.initial_seed() if self.seed is None else self.seed
+            worker = torch.utils.data.get_worker_info()
+            worker_id = 0 if worker is None else worker.id
+            self._rng_state = (state, np.random.default_rng([seed % 2**32, self.epoch, worker_id]))
+        return self._rng_state[1]
+
+    def _case_key(self, case_idx):
+        case_entries = getattr(self.cases, 'cases', None)
+        if case_entries is not None and isinstance(case_entries[case_idx], dict) and 'id' in case_entries[case_idx]:
+            return case_entries[case_idx]['id']
+        return f"case_{case_idx:04d}"
+
+    def _read(self, case_idx, region=None):
+        if hasattr(self.cases, 'read_case'):
+            return self.cases.read_case(case_idx, region)
+        data = self.cases[case_idx]
+        image, labels = np.asarray(data['image']), np.asarray(data['labels'])
+        if region is not None:
+            region = (slice(None),) + tuple(region)
+            image, labels = image[region], labels[region]
+        return {"image": image, "labels": labels}
+
+    # Identity of the labels of a stored case (file, size and mtime), None for cases without a file
+    def _stored_labels_identity(self, case_idx):
+        store_dir = getattr(self.cases, 'store_dir', None)
+        case_entries = getattr(self.cases, 'cases', None)
+        if store_dir is None or case_entries is None or 'labels' not in case_entries[case_idx]:
+            return None
+        path = os.path.realpath(os.path.join(store_dir, case_entries[case_idx]['labels']))
+        stat = os.stat(path)
+        return {"labels_file": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    # Cache file of the centres of a case with the given labels identity (see the class comment)
+    def _cache_file(self, case_idx, identity):
+        description = dict(identity, channels=self.oversample_channels, max_centres=self.max_centres)
+        key = hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{self._case_key(case_idx)}_{key}_centres.npz")
+
+    # Candidate crop centres of a case, a list with one (N, 3) int array per oversampled structure
+    def foreground_centres(self, case_idx):
+        if case_idx in self._centres:
+            return self._centres[case_idx]
+
+        labels = None
+        cache_file = None
+        if self.cache_dir is not None:
+            identity = self._stored_labels_identity(case_idx)
+            if identity is None:
+                labels = np.ascontiguousarray(self._read(case_idx)['labels'])
+                identity = {"labels_sha256": hashlib.sha256(memoryview(labels).cast('B')).hexdigest(),
+                            "shape": list(labels.shape), "dtype": labels.dtype.str}
+            cache_file = self._cache_file(case_idx, identity)
+            if os.path.exists(cache_file):
+                # A file that can't be read (e.g. from an older, interrupted run) is recomputed and replaced
+                try:
+                    with np.load(cache_file) as cached:
+                        centres = [cached[f"c{channel}"] for channel in self.oversample_channels]
+                    self._centres[case_idx] = centres
+                    return centres
+                except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                    print(f"Recomputing the crop centres of case {case_idx}, could not read {cache_file}: {e}")
+
+        if labels is None:
+            labels = np.asarray(self._read(case_idx)['labels'])
+        rng = np.random.default_rng(case_idx)
+        centres = []
+        for channel in self.oversample_channels:
+            mask = label_channel_mask(labels, channel) if labels.ndim == 3 else labels[channel] > 0.5
+            voxels = np.argwhere(mask)
+            if len(voxels) > self.max_centres:
+                voxels = voxels[rng.choice(len(voxels), self.max_centres, replace=False)]
+            centres.append(voxels.astype(np.int32))
+
+        if cache_file is not None:
+            # Written to a temporary file first, so other loader workers never read a partial file
+            cache_tmp = f"{cache_file}.{os.getpid()}.tmp"
+            with open(cache_tmp, 'wb') as file:
+                np.savez(file, **{f"c{channel}": c for channel, c in zip(self.oversample_channels, centres)})
+            os.replace(cache_tmp, cache_file)
+        self._centres[case_idx] = centres
+        return centres
+
+    def _volume_shape(self, case_idx):
+        if hasattr(self.cases, 'image_shape'):
+            return self.cases.image_shape(case_idx)[1:]
+        return np.asarray(self.cases[case_idx]['image']).shape[1:]
+
+    # Region (tuple of slices) of the next crop of a case
+    def sample_region(self, case_idx):
+        rng = self._rng()
+        shape = np.array(self._volume_shape(case_idx))
+        patch = np.array(self.patch_size)
+        if np.any(patch > shape):
+            raise ValueError(f"Patch size {self.patch_size} is larger than the volume {tuple(shape)}")
+
+        centre = None
+        if self.oversample_channels and rng.random() < self.foreground_prob:
+            candidates = [c for c in self.foreground_centres(case_idx) if len(c)]
+            if candidates:
+                structure = candidates[rng.integers(len(candidates))]
+                centre = structure[rng.integers(len(structure))]
+
+        if centre is None:
+            start = rng.integers(0, shape - patch + 1)
+        else:
+            start = np.clip(centre - patch // 2, 0, shape - patch)
+
+        return tuple(slice(int(s), int(s + p)) for s, p in zip(start, patch))
+
+    def __getitem__(self, idx):
+        case_idx = idx // self.patches_per_case
+        return self._read(case_idx, self.sample_region(case_idx))
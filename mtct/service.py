@@ -0,0 +1,227 @@
+"""Pipelined batch prediction: case folders in, per-structure NRRD masks out.
+
+The stages of predict_full_resolution run concurrently, connected by bounded queues:
+
+    read      num_readers threads decode the NRRD files, resample and normalize (prepare_case;
+              squashed to reference_size like load_data by default)
+    infer     one thread runs the sliding-window forward passes on the device
+              (sw_batch_size windows per forward pass)
+    write     num_writers threads threshold, resample back to the CT geometry and write the masks
+
+SimpleITK releases the GIL while it reads and resamples, so the readers and writers keep the
+CPU busy while the model runs. queue_size bounds the number of prepared volumes waiting per
+queue, which bounds the memory. Every case gets output_dir/<case name>_<path digest>/<structure>.nrrd
+and a done.json with its timings (the digest of the resolved case folder keeps same-named folders
+from different input roots apart); case folders with a done.json are skipped, so a run can be
+restarted. watch_case_folders turns an input directory into a stream of new cases:
+
+    service = PredictionService(model, 'masks', device)
+    stats = service.run(list_case_folders('/data/new'))
+    stats = service.run(watch_case_folders('/data/incoming', idle_timeout=3600))
+"""
+
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+from mtct.inference import predict_probabilities, prepare_case, probabilities_to_masks, write_case_masks
+from mtct.labels import label_order as default_label_order
+from mtct.normalization import CT_WINDOW, MR_PERCENTILES
+
+STAGES = ('read', 'infer', 'write')
+DONE_NAME = 'done.json'
+_STOP = object()
+
+# Yield the case folders that appear below input_dir, once their contents stopped changing for
+# one poll_interval. Stops after idle_timeout seconds without a new case (None: never) or when
+# stop_event is set. A missing input_dir raises; a case folder that disappears while it is
+# listed is dropped (and picked up again if it comes back).
+def watch_case_folders(input_dir, poll_interval=10.0, idle_timeout=None, stop_event=None):
+    seen = set()
+    pending = {}
+    last_new = time.monotonic()
+    while stop_event is None or not stop_event.is_set():
+        with os.scandir(input_dir) as entries:
+            folders = sorted(entry.path for entry in entries if entry.is_dir() and entry.path not in seen)
+        for folder in folders:
+            try:
+                with os.scandir(folder) as entries:
+                    snapshot = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in entries)
+            except OSError:
+                pending.pop(folder, None)
+                continue
+            # Still being copied if the listing changed since the last poll
+            if pending.get(folder) == snapshot:
+                del pending[folder]
+                seen.add(folder)
+                last_new = time.monotonic()
+                yield folder
+            else:
+                pending[folder] = snapshot
+        if idle_timeout is not None and not pending and time.monotonic() - last_new > idle_timeout:
+            return
+        time.sleep(poll_interval)
+
+class PredictionService:
+    def __init__(self, model, output_dir, device, roi_size=(128, 128, 128), overlap=0.25, sw_batch_size=4,
+                 threshold=0.5, reference_size=(128, 128, 128), spacing=None, normalization_modes=('minmax', 'minmax'), ct_window=CT_WINDOW,
+                 mr_percentiles=MR_PERCENTILES, label_order=default_label_order, num_readers=2, num_writers=2,
+                 queue_size=2):
+        self.model = model
+        self.output_dir = output_dir
+        self.device = device
+        self.roi_size = roi_size
+        self.overlap = overlap
+        self.sw_batch_size = sw_batch_size
+        self.threshold = threshold
+        self.reference_size = reference_size
+        self.spacing = spacing
+        self.normalization_modes = normalization_modes
+        self.ct_window = ct_window
+        self.mr_percentiles = mr_percentiles
+        self.label_order = label_order
+        self.num_readers = num_readers
+        self.num_writers = num_writers
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+
+    def case_output_dir(self, case_folder):
+        case_folder = os.path.realpath(case_folder)
+        digest = hashlib.sha256(case_folder.encode()).hexdigest()[:8]
+        return os.path.join(self.output_dir, f"{os.path.basename(case_folder)}_{digest}")
+
+    def is_done(self, case_folder):
+        return os.path.exists(os.path.join(self.case_output_dir(case_folder), DONE_NAME))
+
+    def _record(self, stage, seconds):
+        with self._lock:
+            self._stats[stage]['cases'] += 1
+            self._stats[stage]['busy_time'] += seconds
+
+    def _fail(self, case_folder, stage, error):
+        print(f"Prediction failed for {case_folder} ({stage}): {error}")
+        with self._lock:
+            self._failed.append({"case": case_folder, "stage": stage, "error": str(error)})
+
+    # An error of the case_folders iterable is kept for run() to re-raise; the stop markers are
+    # always sent, so the readers and the inference loop wind down either way
+    def _feed(self, case_folders, folder_queue):
+        try:
+            for case_folder in case_folders:
+                if self.is_done(case_folder):
+                    print(f"Skipping {case_folder}, already predicted")
+                    continue
+                folder_queue.put((case_folder, time.perf_counter()))
+        except BaseException as e:
+            self._feed_error = e
+        finally:
+            for _ in range(self.num_readers):
+                folder_queue.put(_STOP)
+
+    def _read(self, folder_queue, read_queue):
+        while (item := folder_queue.get()) is not _STOP:
+            case_folder, submitted = item
+            start = time.perf_counter()
+            try:
+                prepared = prepare_case(case_folder, reference_size=self.reference_size, spacing=self.spacing,
+                                        normalization_modes=self.normalization_modes, ct_window=self.ct_window,
+                                        mr_percentiles=self.mr_percentiles)
+            except Exception as e:
+                self._fail(case_folder, 'read', e)
+                continue
+            self._record('read', time.perf_counter() - start)
+            read_queue.put((case_folder, submitted, prepared))
+
+    def _write(self, write_queue):
+        while (item := write_queue.get()) is not _STOP:
+            case_folder, submitted, probabilities, working_grid, ct_reference = item
+            start = time.perf_counter()
+            try:
+                masks = probabilities_to_masks(probabilities, working_grid, ct_reference, threshold=self.threshold)
+                case_output_dir = self.case_output_dir(case_folder)
+                write_case_masks(masks, case_output_dir, self.label_order)
+                latency = time.perf_counter() - submitted
+                with open(os.path.join(case_output_dir, DONE_NAME), 'w') as file:
+                    json.dump({"case_folder": case_folder, "latency": latency, "threshold": self.threshold}, file)
+            except Exception as e:
+                self._fail(case_folder, 'write', e)
+                continue
+            self._record('write', time.perf_counter() - start)
+            with self._lock:
+                self._latencies.append(latency)
+            print(f"Saved {len(masks)} masks of {case_folder} to {case_output_dir} ({latency:.1f}s)")
+
+    # Predict every case folder of case_folders (any iterable, e.g. watch_case_folders).
+    # Returns per-stage statistics: cases, busy time, throughput (cases per busy second) and
+    # utilization (busy time per wall time, summed over the threads of the stage), plus the
+    # end-to-end latency per case and the failed cases. If iterating case_folders raises, the
+    # cases queued so far are finished and the error is re-raised.
+    def run(self, case_folders):
+        self._stats = {stage: {"cases": 0, "busy_time": 0.0} for stage in STAGES}
+        self._latencies = []
+        self._failed = []
+        self._feed_error = None
+        folder_queue = queue.Queue()
+        read_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        wall_start = time.perf_counter()
+
+        feeder = threading.Thread(target=self._feed, args=(case_folders, folder_queue), daemon=True)
+        readers = [threading.Thread(target=self._read, args=(folder_queue, read_queue), daemon=True)
+                   for _ in range(self.num_readers)]
+        writers = [threading.Thread(target=self._write, args=(write_queue,), daemon=True)
+                   for _ in range(self.num_writers)]
+        for thread in [feeder] + readers + writers:
+            thread.start()
+
+        # The readers are done once all of them returned, then the inference loop gets its stop marker
+        def close_read_queue():
+            for reader in readers:
+                reader.join()
+            read_queue.put(_STOP)
+        threading.Thread(target=close_read_queue, daemon=True).start()
+
+        # Inference runs in the calling thread, so the model and device are only used from here
+        while (item := read_queue.get()) is not _STOP:
+            case_folder, submitted, (image, working_grid, ct_reference) = item
+            start = time.perf_counter()
+            try:
+                probabilities = predict_probabilities(self.model, image, self.device, roi_size=self.roi_size,
+                                                      overlap=self.overlap, sw_batch_size=self.sw_batch_size)
+            except Exception as e:
+                self._fail(case_folder, 'infer', e)
+                continue
+            self._record('infer', time.perf_counter() - start)
+            write_queue.put((case_folder, submitted, probabilities, working_grid, ct_reference))
+
+        for _ in writers:
+            write_queue.put(_STOP)
+        for writer in writers:
+            writer.join()
+        feeder.join()
+        # The cases queued before the error are finished first
+        if self._feed_error is not None:
+            raise self._feed_error
+
+        wall_time = time.perf_counter() - wall_start
+        stages = {}
+        for stage, values in self._stats.items():
+            busy = values['busy_time']
+            stages[stage] = dict(values, throughput=values['cases'] / busy if busy else 0.0,
+                                 utilization=busy / wall_time if wall_time else 0.0)
+        latencies = sorted(self._latencies)
+        stats = {
+            "cases": len(latencies),
+            "failed": self._failed,
+            "wall_time": wall_time,
+            "cases_per_hour": 3600.0 * len(latencies) / wall_time if wall_time else 0.0,
+            "latency_mean": sum(latencies) / len(latencies) if latencies else None,
+            "latency_max": latencies[-1] if latencies else None,
+            "stages": stages,
+        }
+        print(f"Predicted {stats['cases']} cases in {wall_time:.1f}s ({stats['cases_per_hour']:.1f} cases/h), "
+              + ", ".join(f"{stage} {values['busy_time']:.1f}s busy" for stage, values in stages.items()))
+        return stats
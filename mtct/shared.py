@@ -0,0 +1,140 @@
+"""Cases consolidated into a few shared-memory buffers, for DataLoader workers without copies.
+
+A cohort held as a list of {"image": ..., "labels": ...} dicts is copied into every forked
+DataLoader worker bit by bit: touching a case bumps the reference counts of its dict and arrays,
+which writes to their pages and triggers copy-on-write. consolidate_cases packs all cases into
+one shared-memory image buffer and one label buffer (int32 bitfields, see mtct.bitfield) plus an
+(N, 6) offset index, so a worker only holds a handle to the buffers and reads its cases through
+views into them:
+
+    train_dataset = consolidate_cases(train_dataset)
+    del loaded_data_scaled  # the consolidated copy is the only one needed from here on
+    train_loader = make_data_loader(train_dataset, batch_size=2, num_workers=4, shuffle=True)
+
+Spawned workers receive the buffers as shared-memory handles (torch.multiprocessing), forked
+workers inherit them without copy-on-write since the buffers are never written again.
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from mtct.bitfield import pack_label_bits
+
+# Columns of the offset index
+IMAGE_OFFSET, LABEL_OFFSET, CHANNELS, DEPTH, HEIGHT, WIDTH = range(6)
+
+def _shared_buffer(num_elements, dtype):
+    return torch.from_numpy(np.empty(0, dtype=dtype)).new_empty(num_elements).share_memory_()
+
+# (C, D, H, W) masks or a (D, H, W) bitfield of one case -> (num_labels, (D, H, W) int32 bitfield)
+def _case_bits(labels):
+    labels = np.asarray(labels)
+    if labels.ndim == 3 and np.issubdtype(labels.dtype, np.integer):
+        return None, labels.astype(np.int32, copy=False)
+    return labels.shape[0], pack_label_bits(labels)
+
+# Dataset over the shared buffers built by consolidate_cases. read_case/__getitem__ return
+# views into the buffers (images in the stored dtype, only converted when image_dtype differs);
+# they are shared by all workers and must not be modified in place. label_format as for
+# MemmapCaseDataset: 'dense' returns (num_labels, D, H, W) label_dtype masks, 'bitfield' the
+# (D, H, W) int32 bitfield.
+class SharedCaseDataset(Dataset):
+    def __init__(self, images, labels, index, num_labels, image_dtype=np.float32, label_dtype=np.float32,
+                 label_format='dense'):
+        if label_format not in ('dense', 'bitfield'):
+            raise ValueError(f"label_format must be 'dense' or 'bitfield', got {label_format!r}")
+        self.images = images
+        self.labels = labels
+        self.index = index
+        self.num_labels = num_labels
+        self.image_dtype = image_dtype
+        self.label_dtype = label_dtype
+        self.label_format = label_format
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"case index {idx} out of range for {len(self)} cases")
+        return self.read_case(idx)
+
+    @property
+    def nbytes(self):
+        return self.images.nbytes + self.labels.nbytes
+
+    def image_shape(self, idx):
+        return tuple(int(size) for size in self.index[idx, CHANNELS:])
+
+    # Views of the image (C, D, H, W) and the label bitfield (D, H, W) of a case
+    def case_arrays(self, idx):
+        shape = self.image_shape(idx)
+        image_offset, label_offset = int(self.index[idx, IMAGE_OFFSET]), int(self.index[idx, LABEL_OFFSET])
+        image = self.images[image_offset:image_offset + int(np.prod(shape))].numpy().reshape(shape)
+        bits = self.labels[label_offset:label_offset + int(np.prod(shape[1:]))].numpy().reshape(shape[1:])
+        return image, bits
+
+    # Read one case, region is an optional tuple of three slices over (D, H, W)
+    def read_case(self, idx, region=None):
+        image, bits = self.case_arrays(idx)
+        if region is not None:
+            image = image[(slice(None),) + tuple(region)]
+            bits = bits[tuple(region)]
+
+        if image.dtype != np.dtype(self.image_dtype):
+            image = image.astype(self.image_dtype)
+        if self.label_format == 'bitfield':
+            labels = bits
+        else:
+            shifts = np.arange(self.num_labels, dtype=np.int32).reshape(-1, 1, 1, 1)
+            labels = ((bits[np.newaxis] >> shifts) & 1).astype(self.label_dtype)
+        return {"image": image, "labels": labels}
+
+# Copy cases (a list of {"image", "labels"} dicts, or a dataset such as MemmapCaseDataset) into
+# shared memory, one case at a time. Images are stored as storage_dtype (float16 halves the
+# buffer), labels as int32 bitfields. Cases that are None (failed loads) are skipped.
+# num_labels is only needed when the cases already carry bitfield labels.
+# dataset_kwargs are passed on to SharedCaseDataset.
+def consolidate_cases(cases, storage_dtype=np.float32, num_labels=None, **dataset_kwargs):
+    if num_labels is None:
+        num_labels = getattr(cases, 'num_labels', None)
+    # The shapes first, so the buffers are allocated once
+    if hasattr(cases, 'image_shape'):
+        shapes = [tuple(cases.image_shape(i)) for i in range(len(cases))]
+        valid = list(range(len(cases)))
+    else:
+        valid = [i for i, data in enumerate(cases) if data is not None]
+        shapes = [np.shape(cases[i]['image']) for i in valid]
+    if any(len(shape) != 4 for shape in shapes):
+        raise ValueError("Expected (C, D, H, W) images")
+
+    index = np.zeros((len(shapes), 6), dtype=np.int64)
+    index[:, CHANNELS:] = shapes
+    image_sizes = index[:, CHANNELS:].prod(axis=1)
+    label_sizes = index[:, DEPTH:].prod(axis=1)
+    index[1:, IMAGE_OFFSET] = np.cumsum(image_sizes)[:-1]
+    index[1:, LABEL_OFFSET] = np.cumsum(label_sizes)[:-1]
+
+    images = _shared_buffer(int(image_sizes.sum()), storage_dtype)
+    labels = _shared_buffer(int(label_sizes.sum()), np.int32)
+    image_view, label_view = images.numpy(), labels.numpy()
+    for row, i in enumerate(valid):
+        data = cases[i]
+        case_labels, bits = _case_bits(data['labels'])
+        if case_labels is not None:
+            if num_labels is not None and case_labels != num_labels:
+                raise ValueError(f"Case {i} has {case_labels} labels, expected {num_labels}")
+            num_labels = case_labels
+        start = index[row, IMAGE_OFFSET]
+        image_view[start:start + image_sizes[row]] = np.asarray(data['image'], dtype=storage_dtype).ravel()
+        start = index[row, LABEL_OFFSET]
+        label_view[start:start + label_sizes[row]] = bits.ravel()
+    if num_labels is None:
+        raise ValueError("num_labels is required for cases with bitfield labels")
+
+    dataset = SharedCaseDataset(images, labels, index, num_labels, **dataset_kwargs)
+    print(f"Consolidated {len(dataset)} cases into {dataset.nbytes / 2**30:.2f} GiB of shared memory")
+    return dataset
@@ -0,0 +1,186 @@
+"""On-disk store for preprocessed cases, read back through np.memmap.
+
+Layout of a store directory:
+
+    manifest.json          dtypes, shapes and file names of every case, and the label_order
+                           of the label channels
+    case_0000_image.npy    (2, D, H, W) float16/float32 CT + MR
+    case_0000_labels.npy   (ceil(30 / 8), D, H, W) uint8 bit-packed along the channel axis,
+                           or (30, D, H, W) uint8 when written with pack_labels=False
+"""
+
+import json
+import os
+
+import numpy as np
+from torch.utils.data import Dataset
+
+from mtct.bitfield import pack_label_bits
+from mtct.labels import label_order as default_label_order
+
+MANIFEST_NAME = 'manifest.json'
+STORE_VERSION = 1
+
+# Write preprocessed cases ({"image": ..., "labels": ...} dicts, e.g. the output of
+# load_data_parallel or scale_data) to store_dir. cases can be any iterable, so cases are
+# written one by one without holding the whole cohort in memory.
+# Labels are binarised at 0.5 before they are stored. label_order names the label channels.
+def write_dataset_store(cases, store_dir, image_dtype=np.float16, pack_labels=True, label_order=default_label_order):
+    os.makedirs(store_dir, exist_ok=True)
+    image_dtype = np.dtype(image_dtype)
+    if image_dtype not in (np.dtype(np.float16), np.dtype(np.float32)):
+        raise ValueError(f"image_dtype must be float16 or float32, got {image_dtype}")
+
+    manifest = {
+        "version": STORE_VERSION,
+        "image_dtype": image_dtype.name,
+        "label_format": "packbits" if pack_labels else "uint8",
+        "num_labels": None,
+        "label_order": list(label_order),
+        "cases": [],
+    }
+
+    for data in cases:
+        if data is None:
+            continue
+        case_id = f"case_{len(manifest['cases']):04d}"
+        image = np.asarray(data['image'], dtype=image_dtype)
+        labels = np.asarray(data['labels']) > 0.5
+
+        if manifest['num_labels'] is None:
+            manifest['num_labels'] = labels.shape[0]
+        elif labels.shape[0] != manifest['num_labels']:
+            raise ValueError(f"{case_id} has {labels.shape[0]} labels, expected {manifest['num_labels']}")
+        if labels.shape[0] != len(label_order):
+            raise ValueError(f"{case_id} has {labels.shape[0]} labels for {len(label_order)} names in label_order")
+
+        if pack_labels:
+            labels = np.packbits(labels, axis=0)
+        else:
+            labels = labels.astype(np.uint8)
+
+        image_file = f"{case_id}_image.npy"
+        labels_file = f"{case_id}_labels.npy"
+        np.save(os.path.join(store_dir, image_file), image)
+        np.save(os.path.join(store_dir, labels_file), labels)
+
+        manifest['cases'].append({
+            "id": case_id,
+            "image": image_file,
+            "labels": labels_file,
+            "image_shape": list(image.shape),
+        })
+
+    # Written last, so a store interrupted halfway through is never picked up as complete
+    manifest_tmp = os.path.join(store_dir, MANIFEST_NAME + '.tmp')
+    with open(manifest_tmp, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(manifest_tmp, os.path.join(store_dir, MANIFEST_NAME))
+
+    print(f"Stored {len(manifest['cases'])} cases in {store_dir}")
+    return manifest
+
+def load_manifest(store_dir):
+    with open(os.path.join(store_dir, MANIFEST_NAME)) as file:
+        manifest = json.load(file)
+    if manifest.get('version') != STORE_VERSION:
+        raise ValueError(f"Unsupported dataset store version {manifest.get('version')} in {store_dir}")
+    return manifest
+
+# Raise unless the label channels of the store follow label_order. Stores written before the
+# labels were mapped to their channel by name have no label_order and reversed channels.
+def check_label_order(manifest, label_order, store_dir):
+    stored = manifest.get('label_order')
+    if stored is None:
+        raise ValueError(f"Dataset store {store_dir} was written before its label channels were recorded "
+                         "(their order may be reversed), run preprocess again")
+    if stored != list(label_order):
+        raise ValueError(f"Dataset store {store_dir} has the label channels {stored}, expected {list(label_order)}")
+
+# Dataset over a store written by write_dataset_store.
+# Only the manifest is read on construction; every case is opened as a read-only memmap on
+# first access, so startup time and resident memory do not grow with the cohort.
+# case_indices selects a subset of the stored cases (e.g. a train/test split).
+# With label_format='bitfield' the labels are returned as one (D, H, W) int32 bitfield
+# (see mtct.bitfield) instead of (num_labels, D, H, W) label_dtype masks.
+# The label channels of the store have to follow label_order (see check_label_order).
+class MemmapCaseDataset(Dataset):
+    def __init__(self, store_dir, case_indices=None, image_dtype=np.float32, label_dtype=np.float32,
+                 label_format='dense', label_order=default_label_order):
+        if label_format not in ('dense', 'bitfield'):
+            raise ValueError(f"label_format must be 'dense' or 'bitfield', got {label_format!r}")
+        self.store_dir = store_dir
+        self.manifest = load_manifest(store_dir)
+        check_label_order(self.manifest, label_order, store_dir)
+        self.label_order = self.manifest['label_order']
+        self.num_labels = self.manifest['num_labels']
+        self.packed = self.manifest['label_format'] == 'packbits'
+        self.image_dtype = image_dtype
+        self.label_dtype = label_dtype
+        self.label_format = label_format
+
+        cases = self.manifest['cases']
+        if case_indices is None:
+            case_indices = range(len(cases))
+        self.cases = [cases[i] for i in case_indices]
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.cases)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"case index {idx} out of range for {len(self)} cases")
+        return self.read_case(idx)
+
+    # Don't pickle open memmaps, spawned DataLoader workers reopen them on first access
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+    def _open(self, idx):
+        if idx not in self._arrays:
+            case = self.cases[idx]
+            self._arrays[idx] = (
+                np.load(os.path.join(self.store_dir, case['image']), mmap_mode='r'),
+                np.load(os.path.join(self.store_dir, case['labels']), mmap_mode='r'),
+            )
+        return self._arrays[idx]
+
+    def image_shape(self, idx):
+        return tuple(self.cases[idx]['image_shape'])
+
+    # Read one case. region is an optional tuple of three slices over (D, H, W); only the
+    # voxels inside it are read from disk.
+    def read_case(self, idx, region=None):
+        image, labels = self._open(idx)
+        if region is not None:
+            region = (slice(None),) + tuple(region)
+            image = image[region]
+            labels = labels[region]
+
+        image = np.array(image, dtype=self.image_dtype)
+        if self.packed:
+            labels = np.unpackbits(labels, axis=0, count=self.num_labels)
+        if self.label_format == 'bitfield':
+            labels = pack_label_bits(labels)
+        else:
+            labels = np.array(labels, dtype=self.label_dtype)
+
+        return {"image": image, "labels": labels}
+
+# Train/test MemmapCaseDatasets of a store. Only the case indices are split, with the same
+# train_test_split call as the original pickled list, so the partition is unchanged.
+# dataset_kwargs are passed on to both MemmapCaseDatasets.
+def split_store(store_dir, test_size=0.2, random_state=42, **dataset_kwargs):
+    from sklearn.model_selection import train_test_split
+
+    manifest = load_manifest(store_dir)
+    check_label_order(manifest, dataset_kwargs.get('label_order', default_label_order), store_dir)
+    num_cases = len(manifest['cases'])
+    train_indices, test_indices = train_test_split(list(range(num_cases)), test_size=test_size, random_state=random_state)
+    return (MemmapCaseDataset(store_dir, case_indices=train_indices, **dataset_kwargs),
+            MemmapCaseDataset(store_dir, case_indices=test_indices, **dataset_kwargs))
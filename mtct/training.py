@@ -0,0 +1,217 @@
+"""Training loop with early stopping and saving/loading of model checkpoints."""
+
+import contextlib
+import os
+import time
+
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+from mtct.bitfield import dense_labels
+from mtct.distributed import all_reduce_sum, is_distributed, is_main_process
+from mtct.loader import move_batch_to_device
+from mtct.profiling import phase_timer
+
+# Autocast dtype for device: float16 (with GradScaler) on CUDA like before, no autocast on CPU
+# unless a dtype such as torch.bfloat16 is requested.
+def resolve_amp_dtype(device, amp_dtype='auto'):
+    if amp_dtype == 'auto':
+        return torch.float16 if device.type == 'cuda' else None
+    if isinstance(amp_dtype, str):
+        return getattr(torch, amp_dtype)
+    return amp_dtype
+
+# Optionally switch model to channels_last_3d and compile it. Returns the module to call for the
+# forward pass; model itself keeps loss_function and the parameters for the optimizer.
+def prepare_model_for_training(model, channels_last=False, compile_model=False):
+    if channels_last:
+        model.to(memory_format=torch.channels_last_3d)
+    if compile_model:
+        return torch.compile(model)
+    return model
+
+# Training loop with early stopping on the epoch loss.
+# The loss is summed on the device and only read back once per epoch (and every log_interval
+# steps if set), so steps don't wait for each other. accumulation_steps batches are accumulated
+# per optimizer step. amp_dtype selects the autocast dtype ('auto': float16 on CUDA, off on CPU;
+# torch.bfloat16 works on CPU). Returns the per-epoch loss and samples/sec.
+# With a CheckpointManager the full training state is checkpointed in the background after every
+# epoch, and a run that finds a checkpoint in it continues from there (resume=False starts over).
+# augmentation (e.g. a mtct.augmentation.BatchAugmentation) is applied to every batch on the device.
+# A mtct.profiling.StepProfiler records the per-step phase timings and memory of the run.
+# In an initialized process group (distributed=None detects it) the model is trained with
+# DistributedDataParallel, see mtct.distributed.
+def train_model_with_early_stopping(model, train_loader, optimizer, lr_scheduler, device, epochs, patience=5,
+                                    accumulation_steps=1, amp_dtype='auto', channels_last=False, compile_model=False,
+                                    log_interval=None, checkpoint_manager=None, resume=True, augmentation=None,
+                                    profiler=None, distributed=None):
+    device = torch.device(device)
+    amp_dtype = resolve_amp_dtype(device, amp_dtype)
+    distributed = is_distributed() if distributed is None else distributed
+    # Only rank 0 logs and writes checkpoints
+    log = print if is_main_process() else (lambda *args, **kwargs: None)
+    if distributed:
+        model.to(device)
+        # The memory format has to be set before DDP lays out its gradient buckets, compile comes after wrapping
+        if channels_last:
+            model.to(memory_format=torch.channels_last_3d)
+        ddp_model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+        forward_model = prepare_model_for_training(ddp_model, compile_model=compile_model)
+    else:
+        forward_model = prepare_model_for_training(model, channels_last=channels_last, compile_model=compile_model)
+    sampler = getattr(train_loader, 'sampler', None)
+    num_batches = len(train_loader) if hasattr(train_loader, '__len__') else None
+    memory_format = torch.channels_last_3d if channels_last else torch.contiguous_format
+    phase = phase_timer(profiler)
+    model.train()
+    # Loss scaling is only needed for float16
+    scaler = torch.amp.GradScaler(device.type, enabled=amp_dtype == torch.float16)
+
+    best_loss = float('inf')
+    counter = 0  # Counter for early stopping
+    history = []
+    start_epoch = 0
+
+    checkpoint = checkpoint_manager.load() if checkpoint_manager is not None and resume else None
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['model_state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        lr_scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        scaler.load_state_dict(checkpoint['scaler_state_dict'])
+        if augmentation is not None and checkpoint.get('augmentation_state') is not None:
+            augmentation.load_state_dict(checkpoint['augmentation_state'])
+        start_epoch = checkpoint['epoch']
+        best_loss, counter, history = checkpoint['best_loss'], checkpoint['counter'], checkpoint['history']
+        log(f"Resuming from epoch {start_epoch} ({checkpoint_manager.latest()})")
+        if counter >= patience:
+            log(f"Run already stopped early after epoch {start_epoch}.")
+            return history
+
+    for epoch in range(start_epoch, epochs):
+        total_loss = torch.zeros((), device=device)
+        num_steps = 0
+        num_samples = 0
+        epoch_start = time.perf_counter()
+        optimizer.zero_grad(set_to_none=True)
+        # Different shuffle per epoch, the same on all ranks
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+        # Different (seeded) random crops per epoch, also after resuming
+        dataset = getattr(train_loader, 'dataset', None)
+        if hasattr(dataset, 'set_epoch'):
+            dataset.set_epoch(epoch)
+        if profiler is not None:
+            profiler.start()
+
+        for step, batch_data in enumerate(train_loader):
+            if profiler is not None:
+                profiler.start_step()
+            with phase('transfer'):
+                batch_data = move_batch_to_device(batch_data, device)
+                inputs, labels = batch_data['images'], batch_data['labels']
+            if augmentation is not None:
+                with phase('augment'):
+                    inputs, labels = augmentation(inputs, labels)
+            inputs = inputs.contiguous(memory_format=memory_format)
+            # The last batch closes the accumulation window, so ranks never step on unsynchronized gradients
+            optimizer_step = (step + 1) % accumulation_steps == 0 or step + 1 == num_batches
+            # Gradients are only all-reduced on the last batch of an accumulation window
+            sync_context = ddp_model.no_sync() if distributed and not optimizer_step else contextlib.nullcontext()
+            with sync_context:
+                with phase('forward'), torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    outputs = forward_model(inputs)
+                    # Bitfield labels are expanded to the (B, C, D, H, W) target only here, on the device
+                    labels = dense_labels(labels, outputs.shape[1])
+                    loss = model.loss_function(outputs, labels)
+
+                with phase('backward'):
+                    scaler.scale(loss / accumulation_steps).backward()
+            if optimizer_step:
+                with phase('optimizer'):
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
+
+            total_loss += loss.detach().float()
+            num_steps += 1
+            num_samples += inputs.shape[0]
+            if profiler is not None:
+                profiler.end_step(inputs.shape[0])
+            if log_interval and num_steps % log_interval == 0:
+                log(f"Epoch {epoch + 1}/{epochs}, Step {num_steps}, Training Loss: {total_loss.item() / num_steps}")
+
+        # Left-over gradients of an incomplete accumulation window (loaders without a length)
+        if num_batches is None and num_steps % accumulation_steps != 0:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+
+        # Loss over all ranks, so every rank takes the same early-stopping decision
+        total_loss, num_steps, num_samples = all_reduce_sum([total_loss, num_steps, num_samples], device)
+        avg_loss = total_loss / max(num_steps, 1)
+        samples_per_sec = num_samples / (time.perf_counter() - epoch_start)
+        history.append({"epoch": epoch + 1, "loss": avg_loss, "samples_per_sec": samples_per_sec})
+        log(f"Epoch {epoch + 1}/{epochs}, Training Loss: {avg_loss}, {samples_per_sec:.2f} samples/s")
+
+        lr_scheduler.step()
+
+        # Early stopping
+        if avg_loss < best_loss:
+            best_loss = avg_loss
+            counter = 0
+        else:
+            counter += 1
+
+        if checkpoint_manager is not None and is_main_process():
+            checkpoint_manager.save({
+                'model_state_dict': model.state_dict(),
+                'optimizer_state_dict': optimizer.state_dict(),
+                'scheduler_state_dict': lr_scheduler.state_dict(),
+                'scaler_state_dict': scaler.state_dict(),
+                'augmentation_state': augmentation.state_dict() if augmentation is not None else None,
+                'epoch': epoch + 1,
+                'best_loss': best_loss,
+                'counter': counter,
+                'history': history,
+            }, epoch + 1, metric=avg_loss)
+
+        if counter >= patience:
+            log(f"Early stopping after {patience} epochs of no improvement.")
+            break
+
+    if checkpoint_manager is not None:
+        checkpoint_manager.wait()
+    if profiler is not None:
+        profiler.stop()
+        profiler.print_summary()
+    log("Training completed.")
+    return history
+
+# Save or load model (and optimizer) state as model_dir/model_name.
+# The optimizer may be None when only the weights are needed, e.g. for evaluation.
+# For the final weights of a run; checkpoints during training go through mtct.checkpoint.CheckpointManager,
+# whose files can be loaded here as well.
+def save_load_model(model, optimizer, action, model_name='model.pth', model_dir='.'):
+    # Define the path
+    model_path = os.path.join(model_dir, model_name)
+
+    if action == 'save':
+        # Save the model and optimizer
+        os.makedirs(model_dir, exist_ok=True)
+        torch.save({
+            'model_state_dict': model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict() if optimizer is not None else None
+        }, model_path + '.tmp')
+        os.replace(model_path + '.tmp', model_path)
+        print(f'Model saved at: {model_path}')
+
+    elif action == 'load':
+        # Load the model and optimizer
+        checkpoint = torch.load(model_path, map_location='cpu', weights_only=False)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        if optimizer is not None and checkpoint.get('optimizer_state_dict') is not None:
+            optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        print(f'Model loaded from: {model_path}')
+
+    else:
+        print("Invalid action. Please use 'save' or 'load'.")
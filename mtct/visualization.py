@@ -0,0 +1,283 @@
+"""Slice rendering kept off the evaluation hot path.
+
+SliceSink only copies the three orthogonal mid slices of a few samples to the host while
+test_model runs; the figures are drawn later, or in a background process, and saved as PNG files.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+# Same slice order and names as plot_slices_with_labels
+SLICE_NAMES = ('Axial', 'Coronal', 'Sagittal')
+
+# Mid slices of a (C, D, H, W) tensor or array, as three (C, ., .) numpy arrays.
+# Tensors are sliced on their device, so only the slices are copied to the host.
+def extract_mid_slices(volume):
+    depth, height, width = volume.shape[1:]
+    slices = (volume[:, :, height // 2, :], volume[:, :, :, width // 2], volume[:, depth // 2, :, :])
+    if torch.is_tensor(volume):
+        return tuple(s.detach().float().cpu().numpy() for s in slices)
+    return tuple(np.array(s, dtype=np.float32) for s in slices)
+
+# Draw image, label and prediction mid slices (from extract_mid_slices) into a 3x4 grid and save it.
+# Uses the object-oriented matplotlib API with the Agg canvas, no pyplot state is involved.
+# matplotlib is imported here, so with a background SliceSink only the worker process loads it.
+def render_slices(image_slices, label_slices, prediction_slices, title, path):
+    from matplotlib import cm
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(15, 10))
+    FigureCanvasAgg(figure)
+    num_labels = label_slices[0].shape[0]
+
+    for row, name in enumerate(SLICE_NAMES):
+        axes = [figure.add_subplot(3, 4, row * 4 + column + 1) for column in range(4)]
+
+        axes[0].imshow(image_slices[row][0], cmap='gray', aspect='auto')
+        axes[0].set_title(f'CT {name} Slice - {title}')
+        axes[1].imshow(image_slices[row][1], cmap='gray', aspect='auto')
+        axes[1].set_title(f'MR {name} Slice - {title}')
+
+        for ax, maps, kind in ((axes[2], label_slices, 'Label'), (axes[3], prediction_slices, 'Prediction')):
+            for i, binary_map in enumerate(maps[row]):
+                # contour needs some variation, skip empty maps
+                if binary_map.min() == binary_map.max():
+                    continue
+                color = cm.tab20(i / num_labels)
+                ax.contour(binary_map, levels=[0.5], colors=[color], linewidths=2, extent=[0, 1, 0, 1])
+            ax.set_title(f'{kind} Maps {name} Slice - {title}')
+
+    figure.savefig(path)
+    return path
+
+def _render_job(job):
+    return render_slices(*job)
+
+# Collects mid slices of up to max_samples samples during evaluation and renders them to
+# output_dir as PNG files. With background=True every figure is rendered in a worker process as
+# soon as it is added, otherwise all figures are rendered by close(). Call close() when done.
+class SliceSink:
+    def __init__(self, output_dir, max_samples=6, background=True):
+        self.output_dir = output_dir
+        self.max_samples = max_samples
+        self.background = background
+        self.num_samples = 0
+        self._pending = []
+        self._futures = []
+        # Spawned, not forked: the worker starts during evaluation, after CUDA and the loader threads are up
+        self._executor = (ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+                          if background else None)
+        os.makedirs(output_dir, exist_ok=True)
+
+    @property
+    def full(self):
+        return self.num_samples >= self.max_samples
+
+    # Add the samples of a batch: inputs (B, 2, D, H, W), targets and predictions (B, C, D, H, W)
+    def add(self, inputs, targets, predictions, title):
+        for i in range(inputs.shape[0]):
+            if self.full:
+                return
+            path = os.path.join(self.output_dir, f"sample_{self.num_samples:03d}.png")
+            job = (extract_mid_slices(inputs[i]), extract_mid_slices(targets[i]),
+                   extract_mid_slices(predictions[i]), f"{title} #{i}", path)
+            self.num_samples += 1
+            if self._executor is not None:
+                self._futures.append(self._executor.submit(_render_job, job))
+            else:
+                self._pending.append(job)
+
+    # Render what is left and return the paths of all figures
+    def close(self):
+        paths = [render_slices(*job) for job in self._pending]
+        self._pending = []
+        if self._executor is not None:
+            paths = [future.result() for future in self._futures] + paths
+            self._futures = []
+            self._executor.shutdown()
+            self._executor = None
+        return paths
+
+#Plot function for image and labels of one case, shown inline (notebooks)
+def plot_case_slices(image, labels, title):
+    import matplotlib.pyplot as plt
+
+    print(f"Image Element 0 Shape: {image[0].shape}")
+    print(f"Image Element 1 Shape: {image[1].shape}")
+
+    ct_x_slice = image[0][:, image[0].shape[1] // 2, :]
+    ct_y_slice = image[0][:, :, image[0].shape[2] // 2]
+    ct_z_slice = image[0][image[0].shape[0] // 2, :, :]
+
+    mr_x_slice = image[1][:, image[1].shape[1] // 2, :]
+    mr_y_slice = image[1][:, :, image[1].shape[2] // 2]
+    mr_z_slice = image[1][image[1].shape[0] // 2, :, :]
+
+    label_x_slice = []
+    label_y_slice = []
+    label_z_slice = []
+
+    for i in range(len(labels)):
+      label_x_slice.append(labels[i][:, labels[i].shape[1] // 2, :])
+      label_y_slice.append(labels[i][:, :, labels[i].shape[2] // 2])
+      label_z_slice.append(labels[i][labels[i].shape[0] // 2, :, :])
+
+    plt.figure(figsize=(15, 10))
+
+    # Axial slices
+    plt.subplot(3, 3, 1)
+    plt.imshow(image[0][:, image[0].shape[1] // 2, :], cmap='gray', aspect='auto')
+    plt.title('CT Axial Slice - ' + title)
+
+    plt.subplot(3, 3, 2)
+    plt.imshow(image[1][:, image[1].shape[1] // 2, :], cmap='gray', aspect='auto')
+    plt.title('MR Axial Slice - ' + title)
+
+    plt.subplot(3, 3, 3)
+    for i, binary_map in enumerate(label_x_slice):
+      color = plt.cm.tab20(i / 30)  # Choose a color from the Tab20 colormap
+      contours = plt.contour(binary_map, levels=[0.5], colors=[color], linewidths=2, extent=[0, 1, 0, 1])
+
+    plt.title('Label Maps Axial Slice - ' + title)
+
+    # Coronal slices
+    plt.subplot(3, 3, 4)
+    plt.imshow(image[0][:, :, image[0].shape[2] // 2], cmap='gray', aspect='auto')
+    plt.title('CT Coronal Slice - ' + title)
+
+    plt.subplot(3, 3, 5)
+    plt.imshow(image[1][:, :, image[1].shape[2] // 2], cmap='gray', aspect='auto')
+    plt.title('MR Coronal Slice - ' + title)
+
+    plt.subplot(3, 3, 6)
+    for i, binary_map in enumerate(label_y_slice):
+      color = plt.cm.tab20(i / 30)  # Choose a color from the Tab20 colormap
+      contours = plt.contour(binary_map, levels=[0.5], colors=[color], linewidths=2, extent=[0, 1, 0, 1])
+
+    plt.title('Label Maps Coronal Slice - ' + title)
+
+    # Sagittal slices
+    plt.subplot(3, 3, 7)
+    plt.imshow(image[0][image[0].shape[0] // 2, :, :], cmap='gray', aspect='auto')
+    plt.title('CT Sagittal Slice - ' + title)
+
+    plt.subplot(3, 3, 8)
+    plt.imshow(image[1][image[1].shape[0] // 2, :, :], cmap='gray', aspect='auto')
+    plt.title('MR Sagittal Slice - ' + title)
+
+    plt.subplot(3, 3, 9)
+    for i, binary_map in enumerate(label_z_slice):
+      color = plt.cm.tab20(i / 30)  # Choose a color from the Tab20 colormap
+      contours = plt.contour(binary_map, levels=[0.5], colors=[color], linewidths=2, extent=[0, 1, 0, 1])
+
+    plt.title('Label Maps Sagittal Slice - ' + title)
+
+    plt.show()
+
+#Plot function for image label, ground truth and prediction, shown inline (notebooks)
+def plot_slices_with_labels(image, labels, predictions, title):
+    import matplotlib.pyplot as plt
+
+    ct_x_slice = image[0][:, image[0].shape[1] // 2, :]
+    ct_y_slice = image[0][:, :, image[0].shape[2] // 2]
+    ct_z_slice = image[0][image[0].shape[0] // 2, :, :]
+
+    mr_x_slice = image[1][:, image[1].shape[1] // 2, :]
+    mr_y_slice = image[1][:, :, image[1].shape[2] // 2]
+    mr_z_slice = image[1][image[1].shape[0] // 2, :, :]
+
+    label_x_slice = []
+    label_y_slice = []
+    label_z_slice = []
+
+    prediction_x_slice = []
+    prediction_y_slice = []
+    prediction_z_slice = []
+
+    for i in range(len(labels)):
+      label_x_slice.append(labels[i][:, labels[i].shape[1] // 2, :])
+      label_y_slice.append(labels[i][:, :, labels[i].shape[2] // 2])
+      label_z_slice.append(labels[i][labels[i].shape[0] // 2, :, :])
+
+    for i in range(len(labels)):
+      prediction_x_slice.append(predictions[i][:, predictions[i].shape[1] // 2, :])
+      prediction_y_slice.append(predictions[i][:, :, predictions[i].shape[2] // 2])
+      prediction_z_slice.append(predictions[i][predictions[i].shape[0] // 2, :, :])
+
+    plt.figure(figsize=(15, 10))
+
+    # Axial slices
+    plt.subplot(3, 4, 1)
+    plt.imshow(image[0][:, image[0].shape[1] // 2, :], cmap='gray', aspect='auto')
+    plt.title('CT Axial Slice - ' + title)
+
+    plt.subplot(3, 4, 2)
+    plt.imshow(image[1][:, image[1].shape[1] // 2, :], cmap='gray', aspect='auto')
+    plt.title('MR Axial Slice - ' + title)
+
+    plt.subplot(3, 4, 3)
+    for i, binary_map in enumerate(label_x_slice):
+      color = plt.cm.tab20(i / 30)  # Choose a color from the Tab20 colormap
+      contours = plt.contour(binary_map, levels=[0.5], colors=[color], linewidths=2, extent=[0, 1, 0, 1])
+
+    plt.title('Label Maps Axial Slice - ' + title)
+
+    plt.subplot(3, 4, 4)
+    for i, binary_map in enumerate(prediction_x_slice):
+
+      color = plt.cm.tab20(i / 30)  # Choose a color from the Tab20 colormap
+      contours = plt.contour(binary_map, levels=[0.5], colors=[color], linewidths=2, extent=[0, 1, 0, 1])
+
+    plt.title('Predicted Maps Axial Slice - ' + title)
+
+    # Coronal slices
+    plt.subplot(3, 4, 5)
+    plt.imshow(image[0][:, :, image[0].shape[2] // 2], cmap='gray', aspect='auto')
+    plt.title('CT Coronal Slice - ' + title)
+
+    plt.subplot(3, 4, 6)
+    plt.imshow(image[1][:, :, image[1].shape[2] // 2], cmap='gray', aspect='auto')
+    plt.title('MR Coronal Slice - ' + title)
+
+    plt.subplot(3, 4, 7)
+    for i, binary_map in enumerate(label_y_slice):
+      color = plt.cm.tab20(i / 30)  # Choose a color from the Tab20 colormap
+      contours = plt.contour(binary_map, levels=[0.5], colors=[color], linewidths=2, extent=[0, 1, 0, 1])
+
+    plt.title('Label Maps Coronal Slice - ' + title)
+
+    plt.subplot(3, 4, 8)
+    for i, binary_map in enumerate(prediction_y_slice):
+      color = plt.cm.tab20(i / 30)  # Choose a color from the Tab20 colormap
+      contours = plt.contour(binary_map, levels=[0.5], colors=[color], linewidths=2, extent=[0, 1, 0, 1])
+
+    plt.title('Predictions Maps Coronal Slice - ' + title)
+
+    # Sagittal slices
+    plt.subplot(3, 4, 9)
+    plt.imshow(image[0][image[0].shape[0] // 2, :, :], cmap='gray', aspect='auto')
+    plt.title('CT Sagittal Slice - ' + title)
+
+    plt.subplot(3, 4, 10)
+    plt.imshow(image[1][image[1].shape[0] // 2, :, :], cmap='gray', aspect='auto')
+    plt.title('MR Sagittal Slice - ' + title)
+
+    plt.subplot(3, 4, 11)
+    for i, binary_map in enumerate(label_z_slice):
+      color = plt.cm.tab20(i / 30)  # Choose a color from the Tab20 colormap
+      contours = plt.contour(binary_map, levels=[0.5], colors=[color], linewidths=2, extent=[0, 1, 0, 1])
+
+    plt.title('Label Maps Sagittal Slice - ' + title)
+
+    plt.subplot(3, 4, 12)
+    for i, binary_map in enumerate(prediction_z_slice):
+      color = plt.cm.tab20(i / 30)  # Choose a color from the Tab20 colormap
+      contours = plt.contour(binary_map, levels=[0.5], colors=[color], linewidths=2, extent=[0, 1, 0, 1])
+    plt.title('Prediction Maps Sagittal Slice - ' + title)
+
+    plt.show()